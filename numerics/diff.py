@@ -4,6 +4,8 @@ Chapter 05: Differentiation
 (c) Georg Kaufmann
 """
 
+import functools
+
 
 def diff_forward2 (f,x,h):
     '''
@@ -66,3 +68,407 @@ def diff_central5 (f,x,h):
     '''
     df = (f(x-2*h) - 8.*f(x-h) + 8.*f(x+h) - f(x+2*h)) / (12*h)
     return df
+
+
+def _fornberg(z,x,m):
+    '''
+    ----------------------------------------------
+    finite-difference weights for the m-th derivative
+    at z from the nodes x[0..k-1] (Fornberg algorithm)
+    works with Fractions (exact weights) and with
+    numpy arrays (z[npts], x[k] of arrays[npts],
+    weights for many points at once)
+    input:
+    z        - evaluation point(s)
+    x[k]     - list of nodes
+    m        - order of derivative
+    output:
+    c[k]     - list of weights
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    k  = len(x)
+    c  = [[0]*(m+1) for i in range(k)]
+    c1 = 1
+    c4 = x[0]-z
+    c[0][0] = 1
+    for i in range(1,k):
+        mn = min(i,m)
+        c2 = 1
+        c5 = c4
+        c4 = x[i]-z
+        for j in range(i):
+            c3 = x[i]-x[j]
+            c2 = c2*c3
+            if (j == i-1):
+                for l in range(mn,0,-1):
+                    c[i][l] = c1*(l*c[i-1][l-1] - c5*c[i-1][l])/c2
+                c[i][0] = -c1*c5*c[i-1][0]/c2
+            for l in range(mn,0,-1):
+                c[j][l] = (c4*c[j][l] - l*c[j][l-1])/c3
+            c[j][0] = c4*c[j][0]/c3
+        c1 = c2
+    return [c[i][m] for i in range(k)]
+
+
+@functools.lru_cache(maxsize=128)
+def diff_stencil(offsets,deriv=1):
+    '''
+    ----------------------------------------------
+    exact finite-difference stencil for the deriv-th
+    derivative on a uniform grid, weights are
+    num[k]/(den*h**deriv) at points x+offsets[k]*h
+    stencils are computed once and cached
+    input:
+    offsets  - tuple of integer offsets, e.g. (-1,0,1)
+    deriv    - order of derivative (default 1)
+    output:
+    num[k]   - integer numerators (tuple)
+    den      - common integer denominator
+    needs:
+    _fornberg
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import math
+    from fractions import Fraction
+    if (len(offsets) <= deriv):
+        raise ValueError('diff_stencil: need more than deriv offsets')
+    w   = _fornberg(Fraction(0),[Fraction(o) for o in offsets],deriv)
+    den = 1
+    for wk in w:
+        den = den*wk.denominator // math.gcd(den,wk.denominator)
+    num = tuple(int(wk*den) for wk in w)
+    return num,den
+
+
+def diff_offsets(deriv=1,accuracy=2,scheme='central'):
+    '''
+    ----------------------------------------------
+    integer offsets of the stencil for the deriv-th
+    derivative with given order of accuracy
+    input:
+    deriv    - order of derivative (default 1)
+    accuracy - order of accuracy (default 2, even for central)
+    scheme   - 'central', 'forward' or 'backward'
+    output:
+    offsets  - tuple of integer offsets
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    if (scheme == 'central'):
+        if (accuracy%2 != 0):
+            raise ValueError('diff_offsets: accuracy must be even for central scheme')
+        m = (deriv+accuracy-1)//2
+        return tuple(range(-m,m+1))
+    elif (scheme == 'forward'):
+        return tuple(range(0,deriv+accuracy))
+    elif (scheme == 'backward'):
+        return tuple(range(-(deriv+accuracy)+1,1))
+    raise ValueError('diff_offsets: unknown scheme '+str(scheme))
+
+
+def diff_grid(y,x,deriv=1,accuracy=2,scheme='central'):
+    '''
+    ----------------------------------------------
+    approximate the deriv-th derivative of sampled
+    values y[n] on a whole grid with finite-difference
+    stencils applied by array slicing. Points, where
+    the stencil does not fit (boundaries), use
+    one-sided stencils of the same accuracy.
+    On a uniform grid the central stencils give the
+    same numbers as diff_central3 (accuracy=2)
+    and diff_central5 (accuracy=4)
+    input:
+    y[n,...] - function values (derivative along axis 0)
+    x        - grid spacing h (uniform grid) or
+               coordinates x[n] (non-uniform grid)
+    deriv    - order of derivative (default 1)
+    accuracy - order of accuracy (default 2)
+    scheme   - 'central', 'forward' or 'backward'
+    output:
+    dy[n,...] - values of derivative
+    needs:
+    diff_offsets
+    diff_stencil
+    _fornberg
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    y  = np.asarray(y,dtype=float)
+    n  = len(y)
+    offsets = diff_offsets(deriv,accuracy,scheme)
+    nb = deriv+accuracy
+    if (n < max(nb,len(offsets))):
+        raise ValueError('diff_grid: too few grid points for stencil')
+    # interior points i1 <= i < i2, where the stencil fits
+    i1 = -offsets[0]
+    i2 = n-offsets[-1]
+    ileft  = np.arange(0,i1)
+    iright = np.arange(i2,n)
+    dy = np.zeros(y.shape)
+    if (np.ndim(x) == 0):
+        # uniform grid: exact cached stencils
+        h = float(x)
+        num,den = diff_stencil(offsets,deriv)
+        acc = None
+        for o,c in zip(offsets,num):
+            if (c != 0):
+                term = c*y[i1+o:i2+o]
+                acc  = term if (acc is None) else acc + term
+        dy[i1:i2] = acc / (den*h**deriv)
+        # boundary points: one-sided stencils on first/last nb points
+        for i in ileft:
+            num,den = diff_stencil(tuple(range(-i,nb-i)),deriv)
+            dy[i] = np.tensordot(num,y[:nb],axes=1) / (den*h**deriv)
+        for i in iright:
+            num,den = diff_stencil(tuple(range(n-nb-i,n-i)),deriv)
+            dy[i] = np.tensordot(num,y[n-nb:],axes=1) / (den*h**deriv)
+    else:
+        # non-uniform grid: weights for all points of a group at once
+        x = np.asarray(x,dtype=float)
+        groups = [(np.arange(i1,i2),np.array(offsets)[None,:] + np.arange(i1,i2)[:,None])]
+        if (len(ileft) > 0):
+            groups.append((ileft,np.broadcast_to(np.arange(nb),(len(ileft),nb))))
+        if (len(iright) > 0):
+            groups.append((iright,np.broadcast_to(np.arange(n-nb,n),(len(iright),nb))))
+        for i,idx in groups:
+            w = _fornberg(x[i],[x[idx[:,k]] for k in range(idx.shape[1])],deriv)
+            for k in range(idx.shape[1]):
+                wk = w[k].reshape((-1,)+(1,)*(y.ndim-1))
+                dy[i] = dy[i] + wk*y[idx[:,k]]
+    return dy
+
+
+def diff_richardson (f,x,h=0.1,con=2.,nmax=10,safe=2.):
+    '''
+    ----------------------------------------------
+    approximate the first derivative of f(x) with
+    Richardson extrapolation of three-point central
+    differences (Ridders' method): the step size
+    h_i = h/con**i is decreased, each new step costs
+    two evaluations of f, and all previous differences
+    are reused in the extrapolation table. The iteration
+    stops, when the error estimate grows again (round-off)
+    input:
+    f        - external function
+    x        - evalution point
+    h        - initial (largest) stepsize (default 0.1)
+    con      - step reduction factor (default 2)
+    nmax     - max. number of step sizes (default 10)
+    safe     - stop, if error of diagonal grows by safe (default 2)
+    output:
+    df       - value of derivative
+    err      - error estimate
+    hbest    - step size of best estimate
+    nfev     - number of function evaluations
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (h == 0.):
+        raise ValueError('diff_richardson: h must be nonzero')
+    con2  = con*con
+    hh    = h
+    rold  = [(f(x+hh) - f(x-hh)) / (2*hh)]
+    nfev  = 2
+    df    = rold[0]
+    err   = np.inf
+    hbest = hh
+    for i in range(1,nmax):
+        hh   = hh/con
+        rnew = [(f(x+hh) - f(x-hh)) / (2*hh)]
+        nfev = nfev + 2
+        fac  = con2
+        # extrapolation table, only last row is kept
+        for j in range(1,i+1):
+            rnew.append((rnew[j-1]*fac - rold[j-1]) / (fac-1.))
+            fac  = con2*fac
+            errt = max(abs(rnew[j]-rnew[j-1]),abs(rnew[j]-rold[j-1]))
+            if (errt <= err):
+                err   = errt
+                df    = rnew[j]
+                hbest = hh
+        # stop, if higher order is worse by a significant factor
+        if (abs(rnew[i]-rold[i-1]) >= safe*err):
+            break
+        rold = rnew
+    return df,err,hbest,nfev
+
+
+def _diff_eval_points(f,X,vectorized=False,nthreads=1):
+    '''
+    ----------------------------------------------
+    evaluate vector function f at the points X[:,k]
+    vectorized=True: one call f(X[n,k]) -> F[m,k]
+    nthreads>1:      calls f(X[:,k]) in a thread pool
+                     (useful, if f releases the GIL)
+    otherwise:       one call per point
+    output:
+    F[m,k]   - function values
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    k = X.shape[1]
+    if (vectorized):
+        F = np.asarray(f(X),dtype=float)
+        return F.reshape(-1,k)
+    if (nthreads > 1):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            columns = list(pool.map(f,[X[:,i] for i in range(k)]))
+    else:
+        columns = [f(X[:,i]) for i in range(k)]
+    return np.column_stack([np.atleast_1d(np.asarray(c,dtype=float)) for c in columns])
+
+
+def diff_color_columns(sparsity):
+    '''
+    ----------------------------------------------
+    group columns of a sparse Jacobian, such that
+    columns in one group have no nonzero row in
+    common (greedy colouring); all columns of a
+    group can be perturbed with one evaluation of f
+    input:
+    sparsity[m,n] - boolean pattern of nonzeros
+    output:
+    group[n]      - group index of each column
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    s = np.asarray(sparsity,dtype=bool)
+    n = s.shape[1]
+    group = np.zeros(n,dtype=int)
+    rows  = []
+    for j in range(n):
+        for g,used in enumerate(rows):
+            if (not np.any(used & s[:,j])):
+                group[j] = g
+                used |= s[:,j]
+                break
+        else:
+            group[j] = len(rows)
+            rows.append(s[:,j].copy())
+    return group
+
+
+def diff_jacobian(f,x,h=None,scheme='forward',f0=None,vectorized=False,nthreads=1,
+                  bandwidth=None,sparsity=None):
+    '''
+    ----------------------------------------------
+    approximate the Jacobian J[i,j] = df_i/dx_j of a
+    vector function f(x[n]) -> [m] with two-point
+    forward (see diff_forward2) or three-point central
+    (see diff_central3) differences.
+    All perturbed points are evaluated in one batch:
+    with one call f(X[n,k]) (vectorized=True), in a
+    thread pool (nthreads>1) or point by point.
+    For sparse Jacobians, columns without common
+    nonzero rows are perturbed together, a banded
+    Jacobian costs kl+ku+1 (forward) evaluations
+    input:
+    f          - external vector function
+    x[n]       - evaluation point
+    h          - stepsize (scalar or array[n]), default
+                 sqrt(eps) (forward), eps**(1/3) (central)
+                 scaled by max(|x_j|,1)
+    scheme     - 'forward' or 'central' (default 'forward')
+    f0[m]      - f(x), if already known (forward scheme)
+    vectorized - f accepts X[n,k] and returns F[m,k]
+    nthreads   - size of thread pool (default 1)
+    bandwidth  - (kl,ku) lower/upper bandwidth of J
+    sparsity   - boolean pattern of nonzeros [m,n]
+    output:
+    jac[m,n]   - Jacobian matrix
+    nfev       - number of evaluations of f
+    needs:
+    _diff_eval_points
+    diff_color_columns
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    x = np.asarray(x,dtype=float).ravel()
+    n = len(x)
+    if (scheme not in ('forward','central')):
+        raise ValueError('diff_jacobian: unknown scheme '+str(scheme))
+    if (h is None):
+        eps = np.finfo(float).eps
+        h   = (eps**0.5 if (scheme == 'forward') else eps**(1./3.)) * np.maximum(np.abs(x),1.)
+    h = np.broadcast_to(np.asarray(h,dtype=float),(n,))
+    # column groups and pattern of nonzeros
+    pattern = None
+    if (bandwidth is not None):
+        kl,ku = bandwidth
+        group = np.arange(n) % min(n,kl+ku+1)
+    elif (sparsity is not None):
+        pattern = np.asarray(sparsity,dtype=bool)
+        group   = diff_color_columns(pattern)
+    else:
+        group = np.arange(n)
+    ngroup = group.max()+1
+    P = np.zeros([n,ngroup])
+    P[np.arange(n),group] = h
+    # evaluate all perturbed points in one batch
+    if (scheme == 'forward'):
+        X = x[:,None] + P
+        if (f0 is None):
+            X = np.column_stack([X,x])
+        F = _diff_eval_points(f,X,vectorized,nthreads)
+        nfev = X.shape[1]
+        if (f0 is None):
+            f0 = F[:,-1]
+            F  = F[:,:-1]
+        D = F - np.asarray(f0,dtype=float).reshape(-1,1)
+    else:
+        X = np.column_stack([x[:,None]+P,x[:,None]-P])
+        F = _diff_eval_points(f,X,vectorized,nthreads)
+        nfev = X.shape[1]
+        D = (F[:,:ngroup] - F[:,ngroup:]) / 2.
+    jac = D[:,group] / h
+    m   = jac.shape[0]
+    # keep only nonzeros of the column in its group
+    if (bandwidth is not None):
+        i = np.arange(m)[:,None]
+        j = np.arange(n)[None,:]
+        jac[(i-j > kl) | (j-i > ku)] = 0.
+    elif (pattern is not None):
+        jac[~pattern] = 0.
+    return jac,nfev
+
+
+def diff_gradient(f,x,h=None,scheme='central',vectorized=False,nthreads=1):
+    '''
+    ----------------------------------------------
+    approximate the gradient of a scalar function
+    f(x[n]) with finite differences (see diff_jacobian)
+    input:
+    f          - external function
+    x[n]       - evaluation point
+    h          - stepsize (default see diff_jacobian)
+    scheme     - 'forward' or 'central' (default 'central')
+    vectorized - f accepts X[n,k] and returns F[k]
+    nthreads   - size of thread pool (default 1)
+    output:
+    grad[n]    - gradient vector
+    nfev       - number of evaluations of f
+    needs:
+    diff_jacobian
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    jac,nfev = diff_jacobian(f,x,h=h,scheme=scheme,vectorized=vectorized,nthreads=nthreads)
+    return jac[0],nfev
@@ -10,22 +10,116 @@ def chi2(o,p,oerr):
     Least-squares fitting criterion
     input:
     o[n]    - observations
-    p[n]    - predictions data
+    p[n]    - predictions data, or p[...,n] for a
+              batch of predictions
     oerr[n] - uncertainty in observations
     output:
-    chi2    - least-square fit
+    chi2    - least-square fit (chi2[...] for a batch)
     needs:
     -
     from: Lecture Numerical methods in geoscience
     ----------------------------------------------
     """
     import numpy as np
-    chi2 = 0
-    for i in np.range(len(o)):
-        chi2 = chi2 + ((o[i]-p[i])/(oerr[i]))**2
+    r = (np.asarray(o,dtype=float) - np.asarray(p,dtype=float)) / np.asarray(oerr,dtype=float)
+    chi2 = np.sum(r*r,axis=-1)
+    if (chi2.ndim == 0):
+        chi2 = float(chi2)
     return chi2
 
 
+def _chi2_chunk(model,p,x,y,w):
+    '''
+    chi2 for a chunk of parameter vectors p[k,m]; the model
+    is called once with parameter columns of shape [k,1]
+    '''
+    import numpy as np
+    pred = model(x,*[p[:,j:j+1] for j in range(p.shape[1])])
+    r = (y - np.broadcast_to(pred,(p.shape[0],len(x)))) * w
+    return np.einsum('ij,ij->i',r,r)
+
+
+def chi2_surface(model,params,x,y,yerr,nchunk=None,nprocs=1):
+    """
+    ----------------------------------------------
+    chi2 for a batch of parameter vectors, e.g. for
+    grid searches. The model is evaluated for many
+    parameter vectors at once by broadcasting:
+    model(x,p1,...,pm) is called with x[n] and
+    parameter columns pj[k,1] and must return [k,n].
+    Memory is bounded by chunking over parameters;
+    chunks can be spread over a process pool (model
+    must then be a picklable module-level function)
+    input:
+    model     - model function
+    params[k,m] - parameter vectors
+    x[n]      - independent data
+    y[n]      - dependent data
+    yerr[n]   - uncertainty in dependent data
+    nchunk    - parameter vectors per chunk
+                (default: about 1e7 model values)
+    nprocs    - size of process pool (default 1)
+    output:
+    chi2[k]   - chi2 surface
+    pbest[m]  - parameter vector with minimal chi2
+    chi2min   - minimal chi2
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    """
+    import numpy as np
+    params = np.asarray(params,dtype=float)
+    if (params.ndim == 1):
+        params = params[:,None]
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    w = 1. / np.asarray(yerr,dtype=float)
+    k = params.shape[0]
+    if (nchunk is None):
+        nchunk = max(1,10000000//max(len(x),1))
+    chunks = [params[i1:i1+nchunk] for i1 in range(0,k,nchunk)]
+    if (nprocs > 1 and len(chunks) > 1):
+        from concurrent.futures import ProcessPoolExecutor
+        n = len(chunks)
+        with ProcessPoolExecutor(max_workers=nprocs) as pool:
+            parts = list(pool.map(_chi2_chunk,[model]*n,chunks,[x]*n,[y]*n,[w]*n))
+    else:
+        parts = [_chi2_chunk(model,p,x,y,w) for p in chunks]
+    chi2 = np.concatenate(parts) if parts else np.zeros(0)
+    imin = int(np.nanargmin(chi2))
+    return chi2,params[imin],chi2[imin]
+
+
+def chi2_grid(model,axes,x,y,yerr,nchunk=None,nprocs=1):
+    """
+    ----------------------------------------------
+    chi2 surface on a regular parameter grid
+    input:
+    model   - model function (see chi2_surface)
+    axes    - list of m 1D arrays of parameter values
+    x[n]    - independent data
+    y[n]    - dependent data
+    yerr[n] - uncertainty in dependent data
+    nchunk  - parameter vectors per chunk
+    nprocs  - size of process pool (default 1)
+    output:
+    chi2[n1,...,nm] - chi2 surface ('ij' indexing)
+    pbest[m]        - grid point with minimal chi2
+    chi2min         - minimal chi2
+    needs:
+    chi2_surface
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    """
+    import numpy as np
+    axes = [np.asarray(a,dtype=float) for a in axes]
+    grid = np.meshgrid(*axes,indexing='ij')
+    params = np.stack([g.ravel() for g in grid],axis=1)
+    chi2,pbest,chi2min = chi2_surface(model,params,x,y,yerr,nchunk=nchunk,nprocs=nprocs)
+    return chi2.reshape(grid[0].shape),pbest,chi2min
+
+
 
 def fit_linear(x,y,yerr):
     """
@@ -74,6 +168,185 @@ def fit_linear(x,y,yerr):
     return a,b,r,chi2
 
 
+class LineFitAccumulator:
+    """
+    ----------------------------------------------
+    streaming accumulator for a weighted straight-line
+    fit y = a + b*x (see fit_linear): data are added
+    in chunks with update(), partial accumulators
+    from parallel workers are combined with merge().
+    Weighted means and centered sums of squares and
+    products are updated with the pairwise formulas
+    of Chan et al., so no precision is lost for large
+    offsets in x or y, and chi2 follows in one pass
+    ----------------------------------------------
+    """
+    def __init__(self):
+        self.s   = 0.
+        self.xm  = 0.
+        self.ym  = 0.
+        self.cxx = 0.
+        self.cxy = 0.
+        self.cyy = 0.
+        self.n   = 0
+
+    def _combine(self,s,xm,ym,cxx,cxy,cyy,n):
+        if (s == 0.):
+            return
+        stot = self.s + s
+        dx   = xm - self.xm
+        dy   = ym - self.ym
+        f    = self.s*s/stot
+        self.cxx = self.cxx + cxx + dx*dx*f
+        self.cxy = self.cxy + cxy + dx*dy*f
+        self.cyy = self.cyy + cyy + dy*dy*f
+        self.xm  = self.xm + dx*s/stot
+        self.ym  = self.ym + dy*s/stot
+        self.s   = stot
+        self.n   = self.n + n
+
+    def update(self,x,y,yerr,nblock=1000000):
+        '''
+        add data chunk x[n],y[n],yerr[n] (arrays or memory
+        maps, read in blocks of nblock values)
+        '''
+        import numpy as np
+        for i1 in range(0,len(x),nblock):
+            xb = np.asarray(x[i1:i1+nblock],dtype=float)
+            yb = np.asarray(y[i1:i1+nblock],dtype=float)
+            w  = 1. / np.asarray(yerr[i1:i1+nblock],dtype=float)**2
+            # two-pass statistics of the block
+            s  = np.sum(w)
+            xm = np.sum(w*xb) / s
+            ym = np.sum(w*yb) / s
+            dx = xb - xm
+            dy = yb - ym
+            self._combine(s,xm,ym,np.sum(w*dx*dx),np.sum(w*dx*dy),np.sum(w*dy*dy),len(xb))
+        return self
+
+    def merge(self,other):
+        '''
+        add partial accumulator of other data
+        '''
+        self._combine(other.s,other.xm,other.ym,other.cxx,other.cxy,other.cyy,other.n)
+        return self
+
+    def result(self):
+        '''
+        best-fit line from accumulated data:
+        a,b       - intercept and slope of best-fit line
+        vara,varb - variances of a and b
+        r         - correlation coefficient of a and b
+        chi2      - least-square fit
+        '''
+        import numpy as np
+        if (self.n < 2 or self.cxx == 0.):
+            raise ValueError('LineFitAccumulator: not enough data for a line fit')
+        b    = self.cxy / self.cxx
+        a    = self.ym - b*self.xm
+        varb = 1. / self.cxx
+        vara = 1. / self.s + self.xm**2 / self.cxx
+        r    = -self.xm*self.s / np.sqrt(self.s*(self.cxx + self.s*self.xm**2))
+        chi2 = max(self.cyy - self.cxy**2/self.cxx,0.)
+        return a,b,vara,varb,r,chi2
+
+
+def fit_linear_stream(chunks):
+    """
+    ----------------------------------------------
+    fit a straight line to data arriving in chunks,
+    e.g. from a generator or blocks of memory maps
+    input:
+    chunks  - iterable of (x,y,yerr) data chunks
+    output:
+    a,b       - intercept and slope of best-fit line
+    vara,varb - variances of a and b
+    r         - correlation coefficient of a and b
+    chi2      - least-square fit
+    needs:
+    LineFitAccumulator
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    """
+    acc = LineFitAccumulator()
+    for x,y,yerr in chunks:
+        acc.update(x,y,yerr)
+    return acc.result()
+
+
+def fit_design_matrix(f,x,m=4):
+    """
+    ----------------------------------------------
+    design matrix of a set of basis functions,
+    A[i,j] = f(j,x[i]); each basis function is called
+    once with the whole array x, basis functions that
+    only accept scalars are called point by point
+    input:
+    f       - external function f(j,x), j=0,m-1
+    x[n]    - independent data
+    m=4     - number of basis functions (default m=4)
+    output:
+    A[n,m]  - design matrix
+    needs:
+    eval_array
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    """
+    import numpy as np
+    import numerics.roots
+    x = np.asarray(x,dtype=float)
+    A = np.empty([len(x),m])
+    for j in range(m):
+        A[:,j] = numerics.roots.eval_array(lambda xx: f(j,xx),x)
+    return A
+
+
+def fit_linear_lsq(f,x,y,yerr,m=4,method='qr'):
+    """
+    ----------------------------------------------
+    fit a set of function with linear coefficients
+    to  a set of data points, using the weighted
+    design matrix A[i,j] = f(j,x[i])/yerr[i]
+    input:
+    f       - external function f(j,x) used for predictions
+    x[n]    - independent data
+    y[n]    - dependent data
+    yerr[n] - uncertainty in dependent data
+    m=4     - number of arguments (default m=4)
+    method  - 'qr': QR decomposition of design matrix (default)
+              'normal': normal equations with LU factorisation
+    output:
+    a[m]     - model coefficients as array
+    cov[m,m] - covariance matrix of coefficients
+    chi2     - least-square fit
+    needs:
+    fit_design_matrix
+    lin_backward_substitution
+    lin_lu_factor
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    """
+    import numpy as np
+    import numerics.lingl
+    y  = np.asarray(y,dtype=float)
+    w  = 1. / np.asarray(yerr,dtype=float)
+    A  = fit_design_matrix(f,x,m) * w[:,None]
+    bw = y * w
+    if (method == 'qr'):
+        q,r  = np.linalg.qr(A)
+        a    = numerics.lingl.lin_backward_substitution(r,q.T @ bw)
+        rinv = numerics.lingl.lin_backward_substitution(r,np.eye(m))
+        cov  = rinv @ rinv.T
+    elif (method == 'normal'):
+        factor = numerics.lingl.lin_lu_factor(A.T @ A)
+        a   = factor.solve(A.T @ bw)
+        cov = factor.inverse()
+    else:
+        raise ValueError('fit_linear_lsq: unknown method '+str(method))
+    chi2 = np.sum((A @ a - bw)**2)
+    return a,cov,chi2
+
+
 def fit_linear_function(f,x,y,yerr,m=4):
     """
     ----------------------------------------------
@@ -89,6 +362,7 @@ def fit_linear_function(f,x,y,yerr,m=4):
     a[m]    - model coefficients as array
     chi2    - least-square fit
     needs:
+    fit_design_matrix
     lin_lu_decompose
     lin_lu_solve
     from: Lecture Numerical methods in geoscience
@@ -96,26 +370,146 @@ def fit_linear_function(f,x,y,yerr,m=4):
     """
     import numpy as np
     import numerics.lingl
-    n = len(x)
-    alpha = np.zeros(m*m).reshape(m,m)
-    beta  = np.zeros(m)
+    y = np.asarray(y,dtype=float)
+    w = 1. / np.asarray(yerr,dtype=float)**2
     # fill design matrix and rhs vector
-    for j in range(m):
-        for k in range(m):
-            for i in range(n):    
-                alpha[k,j] = alpha[k,j] + f(j,x[i])*f(k,x[i])/yerr[i]**2
-
-    for k in range(m):
-        for i in range(n):
-            beta[k] = beta[k] + y[i]*f(k,x[i])/yerr[i]**2
+    A     = fit_design_matrix(f,x,m)
+    alpha = A.T @ (A * w[:,None])
+    beta  = A.T @ (y * w)
     # solve system with LU decomposition
     l,u = numerics.lingl.lin_lu_decompose(alpha)
     a = numerics.lingl.lin_lu_solve(l,u,beta)
     # chi2 value
-    chi2  = 0.
-    for i in range(n):
-        model = 0.
-        for j in range(m):
-            model = model + a[j]*f(j,x[i])
-        chi2 = chi2 + ((y[i]-model)**2 / yerr[i]**2)
+    chi2 = np.sum((y - A @ a)**2 * w)
     return a,chi2
+
+
+def fit_levenberg_marquardt(f,x,y,yerr,p0,jac=None,tol=1e-8,nmax=200,lam=1e-3,
+                            nbroyden=None,vectorized=False):
+    """
+    ----------------------------------------------
+    fit a nonlinear model f(x,p) with parameters p[m]
+    to a set of data points with the Levenberg-Marquardt
+    method (weights 1/yerr as in fit_linear_function).
+    The Jacobian of the model is computed analytically
+    (jac) or by forward differences (diff_jacobian);
+    between full recomputations it is updated with
+    Broyden rank-1 updates from the evaluated steps,
+    so most iterations cost one model evaluation
+    input:
+    f          - external model function f(x,p) -> [n]
+    x[n]       - independent data
+    y[n]       - dependent data
+    yerr[n]    - uncertainty in dependent data
+    p0[m]      - starting parameters
+    jac        - analytic Jacobian jac(x,p) -> [n,m] (optional)
+    tol        - relative tolerance for parameters and chi2
+    nmax       - maximum number of iterations
+    lam        - initial damping parameter
+    nbroyden   - Broyden updates before the Jacobian is
+                 recomputed (default m)
+    vectorized - f(x[:,None],P[m,k]) returns [n,k]
+                 (finite differences in one call)
+    output:
+    p[m]       - best-fit parameters
+    cov[m,m]   - covariance matrix of parameters
+    chi2       - least-square fit
+    nfev       - number of evaluations of f
+    njev       - number of full Jacobian computations
+    needs:
+    diff_jacobian
+    lin_lu_factor
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    """
+    import numpy as np
+    import numerics.diff
+    import numerics.lingl
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    w = 1. / np.asarray(yerr,dtype=float)
+    p = np.array(p0,dtype=float).ravel()
+    m = len(p)
+    if (nbroyden is None):
+        nbroyden = m
+    nfev = 0
+    njev = 0
+
+    def residual(p):
+        return (np.asarray(f(x,p),dtype=float) - y) * w
+
+    def jacobian(p,e):
+        # weighted Jacobian of the residuals
+        if (jac is not None):
+            return np.asarray(jac(x,p),dtype=float) * w[:,None],0
+        if (vectorized):
+            g = lambda P: (np.asarray(f(x[:,None],P),dtype=float) - y[:,None]) * w[:,None]
+        else:
+            g = residual
+        return numerics.diff.diff_jacobian(g,p,f0=e,vectorized=vectorized)
+
+    e    = residual(p)
+    nfev = nfev + 1
+    chi2 = np.dot(e,e)
+    J,k  = jacobian(p,e)
+    nfev = nfev + k
+    njev = njev + 1
+    fresh   = True
+    nupdate = 0
+    nu = 2.
+    for it in range(nmax):
+        A = J.T @ J
+        g = J.T @ e
+        # damped normal equations, Marquardt scaling
+        D = np.maximum(np.diag(A),np.finfo(float).tiny)
+        try:
+            dp = numerics.lingl.lin_lu_factor(A + lam*np.diag(D)).solve(-g)
+        except np.linalg.LinAlgError:
+            lam = lam*nu
+            nu  = 2.*nu
+            continue
+        if (np.linalg.norm(dp) <= tol*(np.linalg.norm(p)+tol)):
+            if (fresh):
+                break
+            newjac = True
+        else:
+            pnew = p + dp
+            enew = residual(pnew)
+            nfev = nfev + 1
+            chi2new = np.dot(enew,enew)
+            # Broyden rank-1 update with the evaluated step
+            Jnew = J + np.outer(enew - e - J @ dp,dp) / np.dot(dp,dp)
+            pred = -(2.*np.dot(g,dp) + np.dot(dp,A @ dp))
+            if (chi2new < chi2 and pred > 0.):
+                # step accepted
+                rho  = (chi2 - chi2new) / pred
+                lam  = lam * max(1./3.,1.-(2.*rho-1.)**3)
+                nu   = 2.
+                done = chi2 - chi2new <= tol*chi2new
+                p,e,chi2 = pnew,enew,chi2new
+                if (done and fresh):
+                    break
+                newjac = done
+            else:
+                # failed step: first distrust an updated Jacobian
+                if (fresh):
+                    lam = lam*nu
+                    nu  = 2.*nu
+                newjac = not fresh
+            J = Jnew
+            fresh   = False
+            nupdate = nupdate + 1
+            newjac  = newjac or nupdate >= nbroyden
+        if (newjac):
+            J,k  = jacobian(p,e)
+            nfev = nfev + k
+            njev = njev + 1
+            fresh   = True
+            nupdate = 0
+    # covariance from the last full Jacobian
+    if (not fresh):
+        J,k  = jacobian(p,e)
+        nfev = nfev + k
+        njev = njev + 1
+    cov = numerics.lingl.lin_lu_factor(J.T @ J).inverse()
+    return p,cov,chi2,nfev,njev
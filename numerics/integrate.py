@@ -4,6 +4,9 @@ Chapter 06: Integration
 (c) Georg Kaufmann
 """
 
+import functools
+import heapq
+
 def simple_midpoint(f,a,b):
     """
     Simple midpoint integration
@@ -28,7 +31,75 @@ def simple_simpson(f,a,b):
     return simple_simpson
 
 
-def int_trapez (int_f,a,b,n):
+def _composite_sum(int_f,a,b,n,wodd,weven,nchunk):
+    '''
+    ----------------------------------------------
+    weighted sum f(x_0) + f(x_n) + sum w_i f(x_i)
+    over the interior nodes x_i = a+i*h, i=1,n-1,
+    with weights wodd/weven for odd/even i.
+    Interior nodes are processed in blocks of
+    nchunk nodes, the block sums are accumulated
+    with compensated (Neumaier) summation, so
+    memory is independent of n
+    input:
+    int_f   - external function
+    a,b     - integration limits
+    n       - number of sub-intervals
+    wodd    - weight of odd interior nodes
+    weven   - weight of even interior nodes
+    nchunk  - number of nodes per block
+    output:
+    sum     - weighted sum of function values
+    needs:
+    eval_array
+    _neumaier_add
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    import numerics.roots
+    n      = int(n)
+    nchunk = max(1,int(nchunk))
+    h      = (b-a) / float(n)
+    fab    = numerics.roots.eval_array(int_f,np.array([a,b],dtype=float))
+    total  = fab[0] + fab[1]
+    comp   = 0.
+    for i1 in range(1,n,nchunk):
+        i  = np.arange(i1,min(i1+nchunk,n))
+        fx = numerics.roots.eval_array(int_f,a+i*h)
+        if (wodd == weven):
+            part = wodd*np.sum(fx)
+        else:
+            part = wodd*np.sum(fx[i%2 == 1]) + weven*np.sum(fx[i%2 == 0])
+        total,comp = _neumaier_add(total,comp,part)
+    return total + comp
+
+
+def _neumaier_add(total,comp,part):
+    '''
+    ----------------------------------------------
+    compensated (Neumaier) summation step
+    total + comp + part -> total + comp
+    input:
+    total   - running sum
+    comp    - running compensation
+    part    - value to add
+    output:
+    total,comp - updated sum and compensation
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    t = total + part
+    if (abs(total) >= abs(part)):
+        comp = comp + ((total-t) + part)
+    else:
+        comp = comp + ((part-t) + total)
+    return t,comp
+
+
+def int_trapez (int_f,a,b,n,nchunk=1000000):
     '''
     #----------------------------------------------------------------------
     # function integrates the function f(x) between a and b
@@ -37,24 +108,22 @@ def int_trapez (int_f,a,b,n):
     # a        - lower integration limit
     # b        - upper integration limit
     # n        - number of sub-intervals
-    # f        - external function
+    # f        - external function (array or scalar)
+    # nchunk   - number of nodes evaluated at once (default 10^6)
     # output:
     # int_trapez - value of interval
     # (c) Georg Kaufmann
     #----------------------------------------------------------------------
     '''
-    import numpy as npY
     # calculate stepsize
     h = (b-a) / float(n)
     # calculate integral
-    int_trapez = int_f(a) + int_f(b)
-    for i in np.arange(1,n): # i = 1,n-1
-        int_trapez = int_trapez + 2.0*int_f(a+i*h)
+    int_trapez = _composite_sum(int_f,a,b,n,2.0,2.0,nchunk)
     int_trapez = h / 2.0 * int_trapez
     return int_trapez
 
 
-def int_simpson (int_f,a,b,n):
+def int_simpson (int_f,a,b,n,nchunk=1000000):
     '''
     #----------------------------------------------------------------------
     # function integrates the function f(x) between a and b
@@ -63,21 +132,384 @@ def int_simpson (int_f,a,b,n):
     # a        - lower integration limit
     # b        - upper integration limit
     # n        - number of sub-intervals
-    # f        - external function
+    # f        - external function (array or scalar)
+    # nchunk   - number of nodes evaluated at once (default 10^6)
     # output:
     # int_simpson - value of interval
     # (c) Georg Kaufmann
     #----------------------------------------------------------------------
     '''
-    import numpy as npY
-    # calculate stepsize
     if (n%2 != 0):
-        exit ('int_simpson: n must be even')
+        raise ValueError('int_simpson: n must be even')
+    # calculate stepsize
     h = (b-a) / float(n)
-    int_simpson = int_f(a) + int_f(b)
-    for i in np.arange(1,n/2):  # i = 1,n/2-1
-        int_simpson = int_simpson + 2.0*int_f(a+(2*i)*h)
-    for i in np.arange(1,n/2+1): #  1,n/2
-        int_simpson = int_simpson + 4.0*int_f(a+(2*i-1)*h)
+    int_simpson = _composite_sum(int_f,a,b,n,4.0,2.0,nchunk)
     int_simpson = h/3.0 * int_simpson
     return int_simpson
+
+
+def _simpson_panel(a,b,fa,fl,fm,fr,fb):
+    '''
+    ----------------------------------------------
+    Simpson panel [a,b] with function values at
+    a, the quarter points and the midpoint: the
+    coarse and composite Simpson values are
+    compared to estimate the error
+    input:
+    a,b      - panel limits
+    fa,fl,fm,fr,fb - function values at a,(3a+b)/4,
+               (a+b)/2,(a+3b)/4,b
+    output:
+    panel    - heap entry (-err,a,b,fa,fm,fb,fl,fr,value)
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    coarse = (b-a)/6.  * (fa + 4.*fm + fb)
+    fine   = (b-a)/12. * (fa + 4.*fl + 2.*fm + 4.*fr + fb)
+    err    = abs(fine-coarse) / 15.
+    # Richardson extrapolation of the two Simpson values
+    value  = fine + (fine-coarse) / 15.
+    return (-err,a,b,fa,fm,fb,fl,fr,value)
+
+
+def int_adaptive (int_f,a,b,abstol=1.e-10,reltol=1.e-8,maxeval=10000,n=4):
+    '''
+    #----------------------------------------------------------------------
+    # function integrates the function f(x) between a and b
+    # using adaptive Simpson integration (see simple_simpson)
+    # the panel with the largest error estimate is split first
+    # (priority queue), function values at panel end- and midpoints
+    # are reused for the refined panels, each split costs
+    # 4 new function values in one call of f
+    # input:
+    # a        - lower integration limit
+    # b        - upper integration limit
+    # f        - external function (array or scalar)
+    # abstol   - absolute tolerance (default 1e-10)
+    # reltol   - relative tolerance (default 1e-8)
+    # maxeval  - maximum number of function evaluations (default 10000)
+    # n        - number of initial panels (default 4)
+    # output:
+    # int_adaptive - value of integral
+    # err          - error estimate
+    # nfev         - number of function evaluations
+    # (c) Georg Kaufmann
+    #----------------------------------------------------------------------
+    '''
+    import numpy as np
+    import numerics.roots
+    # initial panels, end-, quarter and midpoints in one call
+    x  = np.linspace(a,b,4*n+1)
+    fx = numerics.roots.eval_array(int_f,x)
+    nfev  = 4*n+1
+    heap  = [_simpson_panel(x[4*i],x[4*i+4],*fx[4*i:4*i+5]) for i in range(n)]
+    heapq.heapify(heap)
+    value = sum(panel[8] for panel in heap)
+    err   = sum(-panel[0] for panel in heap)
+    # split panel with largest error until tolerance or budget is reached
+    while (err > max(abstol,reltol*abs(value)) and nfev+4 <= maxeval):
+        perr,pa,pb,fa,fm,fb,fl,fr,pvalue = heapq.heappop(heap)
+        pm = (pa+pb)/2.
+        if (pm <= pa or pm >= pb):
+            # panel cannot be split in floating point
+            heapq.heappush(heap,(perr,pa,pb,fa,fm,fb,fl,fr,pvalue))
+            break
+        # quarter points of both halves in one call
+        xq = np.array([(7.*pa+pb)/8.,(5.*pa+3.*pb)/8.,(3.*pa+5.*pb)/8.,(pa+7.*pb)/8.])
+        fq = numerics.roots.eval_array(int_f,xq)
+        left  = _simpson_panel(pa,pm,fa,fq[0],fl,fq[1],fm)
+        right = _simpson_panel(pm,pb,fm,fq[2],fr,fq[3],fb)
+        nfev  = nfev + 4
+        heapq.heappush(heap,left)
+        heapq.heappush(heap,right)
+        value = value - pvalue + left[8] + right[8]
+        err   = err + perr - left[0] - right[0]
+    # final summation to avoid drift of the running sums
+    value = float(np.sum([panel[8] for panel in heap]))
+    err   = float(np.sum([-panel[0] for panel in heap]))
+    return value,err,nfev
+
+
+def int_romberg (int_f,a,b,nmax=20,tol=1.e-10,table=False):
+    '''
+    #----------------------------------------------------------------------
+    # function integrates the function f(x) between a and b
+    # using Romberg integration: trapezoidal rule with successively
+    # halved step size and Richardson extrapolation
+    # each level only evaluates the new midpoints (one array call),
+    # only the last row of the Romberg table is kept, unless the
+    # full table is requested
+    # input:
+    # a        - lower integration limit
+    # b        - upper integration limit
+    # f        - external function (array or scalar)
+    # nmax     - maximum number of levels (default 20)
+    # tol      - stop, if two successive diagonal elements
+    #            differ by less than tol (default 1e-10)
+    # table    - if True, return the Romberg table as well
+    # output:
+    # int_romberg - value of integral
+    # r[n,n]      - Romberg table (only if table=True)
+    # (c) Georg Kaufmann
+    #----------------------------------------------------------------------
+    '''
+    import numpy as np
+    import numerics.roots
+    fab  = numerics.roots.eval_array(int_f,np.array([a,b],dtype=float))
+    h    = (b-a)
+    rold = np.array([h/2.*(fab[0]+fab[1])])
+    rows = [rold]
+    for i in range(1,nmax):
+        # trapezoidal rule with half step size, new midpoints only
+        xnew = a + h*(np.arange(2**(i-1)) + 0.5)
+        rnew = np.zeros(i+1)
+        rnew[0] = 0.5*(rold[0] + h*np.sum(numerics.roots.eval_array(int_f,xnew)))
+        h = h/2.
+        # Richardson extrapolation
+        for j in range(1,i+1):
+            rnew[j] = rnew[j-1] + (rnew[j-1]-rold[j-1]) / (4.**j-1.)
+        if (table):
+            rows.append(rnew)
+        converged = (i > 1 and abs(rnew[i]-rold[i-1]) <= tol)
+        rold = rnew
+        if (converged):
+            break
+    int_romberg = rold[-1]
+    if (table):
+        r = np.zeros([len(rows),len(rows)])
+        for i,row in enumerate(rows):
+            r[i,:i+1] = row
+        return int_romberg,r
+    return int_romberg
+
+
+@functools.lru_cache(maxsize=32)
+def _gauss_legendre(n):
+    '''
+    ----------------------------------------------
+    Gauss-Legendre nodes and weights on [-1,1]
+    for n points, cached per order (LRU)
+    input:
+    n       - number of nodes
+    output:
+    xroot[n] - nodes (read-only)
+    croot[n] - weights (read-only)
+    needs:
+    numpy.polynomial.legendre.leggauss
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    from numpy.polynomial.legendre import leggauss
+    xroot,croot = leggauss(n)
+    xroot.flags.writeable = False
+    croot.flags.writeable = False
+    return xroot,croot
+
+
+def int_gauss (int_f,a,b,n=10,npanel=1):
+    '''
+    #----------------------------------------------------------------------
+    # function integrates the function f(x) between a and b
+    # using Gauss-Legendre quadrature with n nodes
+    # a and b can be arrays of integration limits, then all
+    # intervals [a_i,b_i] are integrated with one (vectorized)
+    # call to the integrand
+    # input:
+    # a        - lower integration limit(s)
+    # b        - upper integration limit(s)
+    # f        - external function (array or scalar)
+    # n        - number of Gauss nodes per panel (default 10)
+    # npanel   - composite rule: number of panels each interval
+    #            is split into (default 1)
+    # output:
+    # int_gauss - value of integral(s), same shape as a and b
+    # (c) Georg Kaufmann
+    #----------------------------------------------------------------------
+    '''
+    import numpy as np
+    import numerics.roots
+    xroot,croot = _gauss_legendre(int(n))
+    a,b   = np.broadcast_arrays(np.asarray(a,dtype=float),np.asarray(b,dtype=float))
+    shape = a.shape
+    # panel boundaries [k,npanel+1]
+    t   = np.linspace(0.,1.,npanel+1)
+    pe  = a.reshape(-1,1) + (b-a).reshape(-1,1)*t
+    pa  = pe[:,:-1]
+    pb  = pe[:,1:]
+    # nodes [k,npanel,n]
+    xx  = ((pb-pa)[...,None]*xroot + (pa+pb)[...,None]) / 2.
+    fx  = numerics.roots.eval_array(int_f,xx.ravel()).reshape(xx.shape)
+    int_gauss = np.sum((pb-pa) / 2. * (fx @ croot),axis=1).reshape(shape)
+    if (int_gauss.ndim == 0):
+        return float(int_gauss)
+    return int_gauss
+
+
+def int_data_open (filename,xcol=0,ycol=1):
+    '''
+    #----------------------------------------------------------------------
+    # open sampled data x[n],y[n] from the columns of a 2D .npy file
+    # as read-only memory maps, no data are read at this point
+    # (convert text tables such as data/PREM.dat once with
+    # np.save(filename,np.loadtxt(...)))
+    # input:
+    # filename - name of .npy file with array [n,ncol]
+    # xcol     - column of independent data (default 0)
+    # ycol     - column of dependent data (default 1)
+    # output:
+    # x[n],y[n] - memory-mapped columns
+    # (c) Georg Kaufmann
+    #----------------------------------------------------------------------
+    '''
+    import numpy as np
+    data = np.load(filename,mmap_mode='r')
+    return data[:,xcol],data[:,ycol]
+
+
+def _cumulative_output(cumulative,n):
+    '''
+    ----------------------------------------------
+    create output array for cumulative integral:
+    None (no output), a file name (new .npy file,
+    memory-mapped), or an existing array of length n
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (cumulative is None):
+        return None
+    if (isinstance(cumulative,str)):
+        return np.lib.format.open_memmap(cumulative,mode='w+',dtype=float,shape=(n,))
+    if (len(cumulative) != n):
+        raise ValueError('cumulative output must have length n')
+    return cumulative
+
+
+def int_data_trapez (x,y,nblock=1000000,cumulative=None):
+    '''
+    #----------------------------------------------------------------------
+    # function integrates sampled data y(x) with the trapezoidal rule
+    # for (non-uniform) spacing x. The data are read in blocks of
+    # nblock samples, so x and y can be memory maps of arbitrary size
+    # (see int_data_open), peak memory only depends on nblock.
+    # Block sums are added with compensated summation.
+    # input:
+    # x[n]       - independent data (increasing)
+    # y[n]       - dependent data
+    # nblock     - samples per block (default 10^6)
+    # cumulative - None: only integral is returned
+    #              file name: cumulative integral is written
+    #              to a new memory-mapped .npy file
+    #              array[n]: cumulative integral is written to array
+    # output:
+    # int_data_trapez - value of integral
+    # cum[n]          - cumulative integral (if cumulative is set)
+    # (c) Georg Kaufmann
+    #----------------------------------------------------------------------
+    '''
+    import numpy as np
+    n      = len(x)
+    nblock = max(2,int(nblock))
+    cum    = _cumulative_output(cumulative,n)
+    total  = 0.
+    comp   = 0.
+    if (cum is not None):
+        cum[0] = 0.
+    # blocks [i1,i2] overlap by one sample
+    for i1 in range(0,n-1,nblock-1):
+        i2 = min(i1+nblock,n)
+        xb = np.asarray(x[i1:i2],dtype=float)
+        yb = np.asarray(y[i1:i2],dtype=float)
+        parts = (xb[1:]-xb[:-1]) * (yb[1:]+yb[:-1]) / 2.
+        if (cum is not None):
+            cum[i1+1:i2] = (total+comp) + np.cumsum(parts)
+        total,comp = _neumaier_add(total,comp,np.sum(parts))
+    if (cum is not None):
+        if (isinstance(cum,np.memmap)):
+            cum.flush()
+        return total+comp,cum
+    return total+comp
+
+
+def _simpson_pairs(x0,x1,x2,y0,y1,y2):
+    '''
+    ----------------------------------------------
+    Simpson rule for pairs of non-uniform intervals
+    [x0,x1],[x1,x2]: integral over the parabola
+    through the three points, for the first interval
+    and for the whole pair
+    ----------------------------------------------
+    '''
+    h0 = x1-x0
+    h1 = x2-x1
+    hs = h0+h1
+    first = ((2.*h0**2+3.*h0*h1)*y0/hs + (h0**2+3.*h0*h1)*y1/h1
+            - h0**3*y2/(h1*hs)) / 6.
+    pair  = hs/6. * ((2.-h1/h0)*y0 + hs**2/(h0*h1)*y1 + (2.-h0/h1)*y2)
+    return first,pair
+
+
+def int_data_simpson (x,y,nblock=1000000,cumulative=None):
+    '''
+    #----------------------------------------------------------------------
+    # function integrates sampled data y(x) with the Simpson rule
+    # for (non-uniform) spacing x, applied to pairs of intervals.
+    # For an odd number of intervals, the last interval is
+    # integrated with the parabola through the last three samples.
+    # The data are read in blocks of nblock samples, so x and y can be
+    # memory maps of arbitrary size (see int_data_open), peak memory
+    # only depends on nblock. Block sums are added with compensated
+    # summation.
+    # input:
+    # x[n]       - independent data (increasing, n >= 3)
+    # y[n]       - dependent data
+    # nblock     - samples per block (default 10^6)
+    # cumulative - None: only integral is returned
+    #              file name: cumulative integral is written
+    #              to a new memory-mapped .npy file
+    #              array[n]: cumulative integral is written to array
+    # output:
+    # int_data_simpson - value of integral
+    # cum[n]           - cumulative integral (if cumulative is set)
+    # (c) Georg Kaufmann
+    #----------------------------------------------------------------------
+    '''
+    import numpy as np
+    n      = len(x)
+    if (n < 3):
+        raise ValueError('int_data_simpson: at least three samples needed')
+    # number of samples covered by interval pairs
+    npair  = n if (n%2 == 1) else n-1
+    nblock = max(3,int(nblock))
+    nblock = nblock if (nblock%2 == 1) else nblock-1
+    cum    = _cumulative_output(cumulative,n)
+    total  = 0.
+    comp   = 0.
+    if (cum is not None):
+        cum[0] = 0.
+    # blocks [i1,i2] start at even samples and overlap by one sample
+    for i1 in range(0,npair-1,nblock-1):
+        i2 = min(i1+nblock,npair)
+        xb = np.asarray(x[i1:i2],dtype=float)
+        yb = np.asarray(y[i1:i2],dtype=float)
+        first,pair = _simpson_pairs(xb[0:-2:2],xb[1:-1:2],xb[2::2],
+                                    yb[0:-2:2],yb[1:-1:2],yb[2::2])
+        if (cum is not None):
+            c0 = (total+comp) + np.concatenate(([0.],np.cumsum(pair)[:-1]))
+            cum[i1+1:i2:2] = c0 + first
+            cum[i1+2:i2:2] = c0 + pair
+        total,comp = _neumaier_add(total,comp,np.sum(pair))
+    if (npair < n):
+        # last interval: parabola through the last three samples
+        xb = np.asarray(x[n-3:n],dtype=float)
+        yb = np.asarray(y[n-3:n],dtype=float)
+        first,pair = _simpson_pairs(xb[0],xb[1],xb[2],yb[0],yb[1],yb[2])
+        total,comp = _neumaier_add(total,comp,pair-first)
+        if (cum is not None):
+            cum[n-1] = total+comp
+    if (cum is not None):
+        if (isinstance(cum,np.memmap)):
+            cum.flush()
+        return total+comp,cum
+    return total+comp
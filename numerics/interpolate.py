@@ -4,6 +4,8 @@ Chapter 04: Interpolation
 (c) Georg Kaufmann
 """
 
+import functools
+
 
 def pol_lagrange_basis(xint,xdata,n,k):
     '''
@@ -52,6 +54,104 @@ def pol_lagrange (xint,xdata,ydata):
     return yint
 
 
+def pol_barycentric_weights(xdata):
+    '''
+    ----------------------------------------------
+    calculates barycentric weights of Lagrange
+    interpolation w_k = 1 / prod_{i!=k} (x_k-x_i)
+    weights are cached per set of data points, a
+    repeated call with the same xdata costs O(n)
+    input:
+    xdata[0:n] - data points x value
+    output:
+    w[0:n]     - barycentric weights (read-only)
+    needs:
+    _barycentric_weights_cached
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    xdata = np.ascontiguousarray(xdata,dtype=float)
+    return _barycentric_weights_cached(xdata.tobytes())
+
+
+@functools.lru_cache(maxsize=64)
+def _barycentric_weights_cached(key):
+    import numpy as np
+    xdata = np.frombuffer(key,dtype=float)
+    diff  = xdata[:,None] - xdata[None,:]
+    np.fill_diagonal(diff,1.)
+    w = 1. / np.prod(diff,axis=1)
+    w.flags.writeable = False
+    return w
+
+
+def pol_barycentric_add_node(xdata,w,xnew):
+    '''
+    ----------------------------------------------
+    update barycentric weights in O(n), when the
+    new data point xnew is added to xdata
+    input:
+    xdata[0:n] - data points x value
+    w[0:n]     - barycentric weights of xdata
+    xnew       - new data point
+    output:
+    xdata[0:n+1] - extended data points
+    w[0:n+1]     - extended barycentric weights
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    xdata = np.asarray(xdata,dtype=float)
+    diff  = xdata - xnew
+    if (np.any(diff == 0.)):
+        raise ValueError('pol_barycentric_add_node: node already in xdata')
+    w = np.append(w / diff,1. / np.prod(-diff))
+    return np.append(xdata,xnew),w
+
+
+def pol_barycentric(xint,xdata,ydata,w=None):
+    '''
+    ----------------------------------------------
+    calculate Lagrange interpolation polynomial
+    with the barycentric formula
+    p(x) = sum w_k y_k/(x-x_k) / sum w_k/(x-x_k)
+    O(n) per interpolation point, identical to
+    pol_lagrange in exact arithmetic
+    input:
+    xint       - x coordinate (scalar or array)
+    xdata[0:n] - data points x value
+    ydata[0:n] - data points y value
+    w[0:n]     - barycentric weights (optional,
+                 default: pol_barycentric_weights)
+    output:
+    yint  - value of Lagrange interpolation polynomial
+    needs:
+    pol_barycentric_weights
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    xdata = np.asarray(xdata,dtype=float)
+    ydata = np.asarray(ydata,dtype=float)
+    if (w is None):
+        w = pol_barycentric_weights(xdata)
+    xarr = np.asarray(xint,dtype=float).ravel()
+    diff = xarr[:,None] - xdata[None,:]
+    # interpolation points, which coincide with data points
+    exact = (diff == 0.)
+    diff[exact] = 1.
+    t    = w / diff
+    yint = (t @ ydata) / np.sum(t,axis=1)
+    irow,icol = np.nonzero(exact)
+    yint[irow] = ydata[icol]
+    if (np.ndim(xint) == 0):
+        return yint[0]
+    return yint.reshape(np.shape(xint))
+
+
 def pol_spline10(x,y):
     '''
     ----------------------------------------------
@@ -74,35 +174,71 @@ def pol_spline10(x,y):
     return b10
 
 
-def pol_splint10(xint,x,y,b10):
+def _spline_interval(xint,x,presorted=False):
+    '''
+    ----------------------------------------------
+    find spline intervals i with x[i] <= xint < x[i+1]
+    for an array of interpolation points
+    input:
+    xint[m]   - interpolation points
+    x[n]      - knots (increasing)
+    presorted - False: binary search for each point, O(m log n)
+                True:  xint is increasing, binary search of
+                each knot in xint and cumulative count of
+                knots, O(n log m + m) (for m >> n)
+    output:
+    i[m]      - interval index, clipped to [0,n-2]
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    n = len(x)
+    if (presorted):
+        if (np.any(np.diff(xint) < 0)):
+            raise ValueError('_spline_interval: xint is not increasing (presorted=True)')
+        # number of knots <= xint[j]: position of each knot in xint, cumulative count
+        pos = np.searchsorted(xint,x,side='left')
+        i   = np.cumsum(np.bincount(pos,minlength=len(xint)+1))[:len(xint)] - 1
+    else:
+        i   = np.searchsorted(x,xint,side='right') - 1
+    return np.clip(i,0,n-2)
+
+
+def pol_splint10(xint,x,y,b10,presorted=False):
     '''
     ----------------------------------------------
     calculation of linear spline
     input:
-    xint   - interpolation point
+    xint   - interpolation point (scalar or array)
     x[n]   - independent data coordinate
     y[n]   - dependent data coordinate
     b10    - array of slope coefficients
+    presorted=False - set True for increasing xint
+             (streaming search through the knots)
     output:
     yint10 - spline interpolation
     needs:
-    -
+    _spline_interval
     from: Lecture Numerical methods in geoscience
     ----------------------------------------------
     '''
     import numpy as np
-    n = len(x)
-    # if xint is outside the x() interval take a boundary value (left or right)
-    if (xint <= x[0]):
-        yint10 = y[0]
-    elif (xint >= x[n-1]):
-        yint10 = y[n-1]
+    x    = np.asarray(x)
+    y    = np.asarray(y)
+    b10  = np.asarray(b10)
+    n    = len(x)
+    xarr = np.atleast_1d(np.asarray(xint,dtype=float))
     # find interval and evaluate spline interpolation
-    else:
-        for i in np.arange(0,n-1):
-            if (xint >= x[i] and xint <= x[i+1]):
-                h      = xint - x[i]
-                yint10 = y[i] + b10[i]*h
+    i      = _spline_interval(xarr,x,presorted)
+    h      = xarr - x[i]
+    yint10 = y[i] + b10[i]*h
+    # if xint is outside the x() interval take a boundary value (left or right)
+    yint10 = np.where(xarr <= x[0],y[0],yint10)
+    yint10 = np.where(xarr >= x[n-1],y[n-1],yint10)
+    if (np.ndim(xint) == 0):
+        return yint10[0]
     return yint10
 
 
@@ -166,36 +302,273 @@ def pol_spline32(x,y):
     return b32,c32,d32
 
 
-def pol_splint32(xint,x,y,b32,c32,d32):
+def pol_spline32_factor(x):
+    '''
+    ----------------------------------------------
+    factorisation of the tridiagonal system of
+    pol_spline32, which depends on the knots x only
+    input:
+    x[n]   - independent data coordinate
+    output:
+    factor - tuple (x,h,diag,mult) with
+             h[n-1]  - knot spacings
+             diag[n] - diagonal after forward elimination
+             mult[n] - elimination multipliers
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    x = np.asarray(x,dtype=float)
+    n = len(x)
+    h = x[1:] - x[:-1]
+    diag = np.zeros(n)
+    diag[0]     = -h[0]
+    diag[1:n-1] = 2.0*(h[:n-2] + h[1:n-1])
+    diag[n-1]   = -h[n-2]
+    # forward elimination of the matrix (rhs independent)
+    mult = np.zeros(n)
+    for i in range(1,n):
+        mult[i]  = h[i-1]/diag[i-1]
+        diag[i]  = diag[i] - mult[i]*h[i-1]
+    return x,h,diag,mult
+
+
+def pol_spline32_batch(x,y,factor=None):
+    '''
+    ----------------------------------------------
+    calculation of coefficients for cubic splines
+    of many data series y[:,k] sharing the knots x,
+    same end conditions and coefficients as
+    pol_spline32. The tridiagonal matrix is factored
+    once and all series are solved together
+    input:
+    x[n]     - independent data coordinate
+    y[n,k]   - dependent data coordinate (k series)
+    factor   - result of pol_spline32_factor(x) (optional)
+    output:
+    b32[n,k] - array of linear coefficients
+    c32[n,k] - array of quadratic coefficients
+    d32[n,k] - array of cubic coefficients
+    needs:
+    pol_spline32_factor
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (factor is None):
+        factor = pol_spline32_factor(x)
+    x,h,diag,mult = factor
+    y   = np.asarray(y,dtype=float)
+    y2d = y.reshape(len(y),-1)
+    n   = len(x)
+    hc  = h[:,None]
+    # step 1: preparation (rhs from slopes)
+    slope = (y2d[1:] - y2d[:-1])/hc
+    c32 = np.zeros(y2d.shape)
+    c32[1:n-1] = slope[1:] - slope[:-1]
+    # step 2: end conditions
+    if (n != 3):
+        c32[0]   = c32[2]/(x[3]-x[1]) - c32[1]/(x[2]-x[0])
+        c32[n-1] = c32[n-2]/(x[n-1]-x[n-3]) - c32[n-3]/(x[n-2]-x[n-4])
+        c32[0]   = c32[0]*h[0]**2/(x[3]-x[0])
+        c32[n-1] = -c32[n-1]*h[n-2]**2/(x[n-1]-x[n-4])
+    # step 3: forward elimination (all series at once)
+    for i in range(1,n):
+        c32[i] = c32[i] - mult[i]*c32[i-1]
+    # step 4: back substitution
+    c32[n-1] = c32[n-1]/diag[n-1]
+    for i in range(n-1,0,-1):
+        c32[i-1] = (c32[i-1] - h[i-1]*c32[i])/diag[i-1]
+    # step 5: compute spline coefficients
+    b32 = np.zeros(y2d.shape)
+    d32 = np.zeros(y2d.shape)
+    b32[n-1]  = (y2d[n-1] - y2d[n-2])/h[n-2] + h[n-2]*(c32[n-2] + 2.0*c32[n-1])
+    b32[:n-1] = slope - hc*(c32[1:] + 2.0*c32[:n-1])
+    d32[:n-1] = (c32[1:] - c32[:n-1])/hc
+    d32[n-1]  = d32[n-2]
+    c32 = 3.0*c32
+    if (y.ndim == 1):
+        return b32[:,0],c32[:,0],d32[:,0]
+    return b32,c32,d32
+
+
+def pol_splint32(xint,x,y,b32,c32,d32,presorted=False):
     '''
     #----------------------------------------------------------------------
     calculation of cubic spline
     input:
-    xint   - interpolation point
+    xint   - interpolation point (scalar or array)
     x[n]   - independent data coordinate
     y[n]   - dependent data coordinate
     b32    - array of linear coefficients
     c32    - array of quadratic coefficients
     d32    - array of cubic coefficients
+    presorted=False - set True for increasing xint
+             (streaming search through the knots)
     output:
     yint32 - spline interpolation
     needs:
-    -
+    _spline_interval
     from: Lecture Numerical methods in geoscience
     #----------------------------------------------------------------------
     '''
     import numpy as np
-    n = len(x)
+    x    = np.asarray(x)
+    y    = np.asarray(y)
+    b32  = np.asarray(b32)
+    c32  = np.asarray(c32)
+    d32  = np.asarray(d32)
+    n    = len(x)
+    xarr = np.atleast_1d(np.asarray(xint,dtype=float))
+    # find interval and evaluate spline interpolation (Horner scheme)
+    i      = _spline_interval(xarr,x,presorted)
+    h      = xarr - x[i]
+    yint32 = y[i] + h*(b32[i] + h*(c32[i] + h*d32[i]))
     # if xint is outside the x() interval take a boundary value (left)
-    if (xint <= x[0]):
-        yint32 = y[0]
+    yint32 = np.where(xarr <= x[0],y[0],yint32)
     # if xint is outside the x() interval take a boundary value (right)
-    elif (xint >= x[n-1]):
-        yint32 = y[n-1]
-    # find interval and evaluate spline interpolation
-    else:
-        for i in np.arange(0,n-1): # 1,n-1
-            if (xint >= x[i] and xint <= x[i+1]):
-                h      = xint - x[i]
-                yint32 = y[i] + b32[i]*h + c32[i]*(h**2) + d32[i]*(h**3)
+    yint32 = np.where(xarr >= x[n-1],y[n-1],yint32)
+    if (np.ndim(xint) == 0):
+        return yint32[0]
     return yint32
+
+
+class Spline:
+    '''
+    ----------------------------------------------
+    piecewise polynomial spline
+    S_i(x) = y_i + b_i h + c_i h^2 + d_i h^3, h = x-x_i
+    knots and coefficients are kept in one
+    contiguous array coef[5,n] = [x,y,b,c,d],
+    which can be saved to a .npy file and loaded
+    again as memory map (shared between processes)
+    input:
+    x[n]     - independent data coordinate
+    y[n]     - dependent data coordinate
+    degree=3 - 1: linear spline (pol_spline10)
+               3: cubic spline (pol_spline32)
+    needs:
+    pol_spline10
+    pol_spline32
+    _spline_interval
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    def __init__(self,x,y,degree=3):
+        import numpy as np
+        x = np.asarray(x,dtype=float)
+        y = np.asarray(y,dtype=float)
+        n = len(x)
+        coef = np.zeros([5,n])
+        coef[0] = x
+        coef[1] = y
+        if (degree == 1):
+            coef[2] = pol_spline10(x,y)
+        elif (degree == 3):
+            coef[2],coef[3],coef[4] = pol_spline32(x,y)
+        else:
+            raise ValueError('Spline: degree must be 1 or 3')
+        self._set(coef)
+
+    @classmethod
+    def from_array(cls,coef):
+        '''
+        create spline from coefficient array coef[5,n]
+        (no copy is made)
+        '''
+        spline = cls.__new__(cls)
+        spline._set(coef)
+        return spline
+
+    @classmethod
+    def load(cls,filename,mmap_mode='r'):
+        '''
+        load spline from .npy file, by default as
+        read-only memory map (mmap_mode=None reads
+        the array into memory)
+        '''
+        import numpy as np
+        return cls.from_array(np.load(filename,mmap_mode=mmap_mode))
+
+    def save(self,filename):
+        '''
+        save knots and coefficients to .npy file
+        '''
+        import numpy as np
+        np.save(filename,self.coef)
+
+    def _set(self,coef):
+        if (coef.ndim != 2 or coef.shape[0] != 5 or coef.shape[1] < 2):
+            raise ValueError('Spline: coefficient array must have shape [5,n], n>=2')
+        self.coef = coef
+        self.x,self.y,self.b,self.c,self.d = coef
+        self._cumint = None
+
+    def _locate(self,xint):
+        import numpy as np
+        xarr = np.atleast_1d(np.asarray(xint,dtype=float))
+        i    = _spline_interval(xarr,self.x)
+        return xarr,i,xarr-self.x[i]
+
+    def __call__(self,xint):
+        '''
+        evaluate spline at xint (scalar or array),
+        outside [x0,x(n-1)] the boundary value is taken
+        '''
+        return self.derivative(xint,order=0)
+
+    def derivative(self,xint,order=1):
+        '''
+        evaluate derivative of given order (0,1,2,3)
+        at xint (scalar or array), outside [x0,x(n-1)]
+        the spline is constant and derivatives vanish
+        '''
+        import numpy as np
+        xarr,i,h = self._locate(xint)
+        b,c,d = self.b[i],self.c[i],self.d[i]
+        if (order == 0):
+            s = self.y[i] + h*(b + h*(c + h*d))
+            s = np.where(xarr <= self.x[0],self.y[0],s)
+            s = np.where(xarr >= self.x[-1],self.y[-1],s)
+        else:
+            if (order == 1):
+                s = b + h*(2.*c + 3.*d*h)
+            elif (order == 2):
+                s = 2.*c + 6.*d*h
+            elif (order == 3):
+                s = 6.*d
+            else:
+                s = np.zeros(len(xarr))
+            s = np.where((xarr < self.x[0]) | (xarr > self.x[-1]),0.,s)
+        if (np.ndim(xint) == 0):
+            return s[0]
+        return s
+
+    def antiderivative(self,xint):
+        '''
+        exact integral of spline from x0 to xint
+        (scalar or array), constant continuation
+        outside [x0,x(n-1)]
+        '''
+        import numpy as np
+        if (self._cumint is None):
+            h = np.diff(self.x)
+            y,b,c,d = self.y[:-1],self.b[:-1],self.c[:-1],self.d[:-1]
+            self._cumint = np.zeros(len(self.x))
+            self._cumint[1:] = np.cumsum(h*(y + h*(b/2. + h*(c/3. + h*d/4.))))
+        xarr,i,h = self._locate(xint)
+        h = np.clip(h,0.,self.x[i+1]-self.x[i])
+        s = self._cumint[i] + h*(self.y[i] + h*(self.b[i]/2. + h*(self.c[i]/3. + h*self.d[i]/4.)))
+        s = s + np.minimum(xarr-self.x[0],0.)*self.y[0] + np.maximum(xarr-self.x[-1],0.)*self.y[-1]
+        if (np.ndim(xint) == 0):
+            return s[0]
+        return s
+
+    def integrate(self,a,b):
+        '''
+        exact definite integral of spline from a to b
+        (scalars or arrays of limits)
+        '''
+        return self.antiderivative(b) - self.antiderivative(a)
@@ -4,43 +4,87 @@ Chapter 07: Linear system of equations
 (c) Georg Kaufmann
 """
 
-def lin_gauss(a,b):
+import collections
+import hashlib
+
+# LRU cache of LU factors, see lin_factor_cached()
+_lu_cache = collections.OrderedDict()
+_lu_cache_maxsize = 16
+
+
+def lin_gauss(a,b,pivot=True,scaled=False,overwrite=False):
     '''
     ----------------------------------------------
     Solve the system of linear equations a(n,n)*x(n) = b(n)
-    using the Gauss algorithm with pivoting
+    using the Gauss algorithm with partial pivoting
+    Each elimination step updates all rows below the
+    pivot with array operations. A stack of systems
+    a[k,n,n], b[k,n] is solved in one call, the
+    elimination runs over all systems at once
     input:
-    a[n,n]  - coefficient matrix
-    b[n]    - rhs vector
+    a[n,n]    - coefficient matrix (or stack a[k,n,n])
+    b[n]      - rhs vector (or b[n,m], b[k,n], b[k,n,m])
+    pivot     - partial (row) pivoting (default True)
+    scaled    - scaled pivoting, pivot candidates are
+                divided by the largest element of their
+                row (default False)
+    overwrite - reuse a and b (float arrays) as work
+                arrays, they are destroyed (default False)
     output:
-    x[n]    - solution vector
+    x[n]      - solution vector (same shape as b)
+    raises:
+    numpy.linalg.LinAlgError, if a matrix is singular
     needs:
     -
     from: Lecture Numerical methods in geoscience
     ----------------------------------------------
     '''
     import numpy as np
-    n = len(b)
+    if (overwrite):
+        a = np.asarray(a,dtype=float)
+        b = np.asarray(b,dtype=float)
+    else:
+        a = np.array(a,dtype=float)
+        b = np.array(b,dtype=float)
+    shape = b.shape
+    # work on stacks a[k,n,n], b[k,n,m]
+    if (a.ndim == 2):
+        a = a[None]
+        b = b[None]
+    if (b.ndim == 2):
+        b = b[...,None]
+    nsys,n = a.shape[0],a.shape[1]
+    isys   = np.arange(nsys)
+    if (scaled):
+        s = np.max(np.abs(a),axis=2)
+        s[s == 0.] = 1.
     # Gauss elimination with pivoting
-    for i in np.arange(0,n): # 1,n-1
-        for k in np.arange(i+1,n): # i+1,n
-            if (a[i][i] == 0.):
-                exit ('lin_gauss: pivot element is zero')
-            pivot = a[k][i] / a[i][i]
-            for j in np.arange(0,i):
-                a[k,j] = 0.0     # not really needed
-            for j in np.arange(i+1,n): # i+1,n
-                a[k][j] = a[k][j] - pivot*a[i][j]
-            b[k] = b[k] - pivot*b[i]
+    for k in range(n):
+        if (pivot):
+            col = np.abs(a[:,k:,k])
+            if (scaled):
+                col = col / s[:,k:]
+            p = k + np.argmax(col,axis=1)
+            swap = isys[p != k]
+            if (len(swap) > 0):
+                ps = p[swap]
+                a[swap,k],a[swap,ps] = a[swap,ps],a[swap,k]
+                b[swap,k],b[swap,ps] = b[swap,ps],b[swap,k]
+                if (scaled):
+                    s[swap,k],s[swap,ps] = s[swap,ps],s[swap,k]
+        piv = a[:,k,k]
+        if (np.any(piv == 0.)):
+            raise np.linalg.LinAlgError('lin_gauss: matrix is singular (system %i)'
+                                        % np.flatnonzero(piv == 0.)[0])
+        factor = a[:,k+1:,k] / piv[:,None]
+        a[:,k+1:,k:] -= factor[:,:,None] * a[:,None,k,k:]
+        b[:,k+1:]    -= factor[:,:,None] * b[:,None,k]
     # solve reduced system with backward substitution
-    x = np.zeros([n])
-    for i in np.arange(n-1,-1,step=-1): # n,1,-1
-        sum = 0.0
-        for j in np.arange(i+1,n): # i+1,n
-            sum = sum + a[i][j] * x[j]
-        x[i] = (b[i] - sum) / a[i][i]
-    return x
-
+    x = b
+    for i in range(n-1,-1,-1):
+        x[:,i] -= np.einsum('kj,kjm->km',a[:,i,i+1:],x[:,i+1:])
+        x[:,i] /= a[:,i,i][:,None]
+    return x.reshape(shape)
 
 
 def lin_lu_decompose(a):
@@ -48,6 +92,9 @@ def lin_lu_decompose(a):
     ----------------------------------------------
     LU decomposition of matrix A 
     into lower L and upper U triangular matrices
+    (Doolittle, row i of U and column i of L are
+    computed with array operations, no pivoting,
+    see lin_lu_factor for a pivoted factorisation)
     input:
     a[n,n]  - coefficient matrix
     output:
@@ -59,62 +106,891 @@ def lin_lu_decompose(a):
     ----------------------------------------------
     """
     import numpy as np
+    a = np.asarray(a,dtype=float)
     n = a.shape[0]
-    l = np.zeros([n,n])
+    l = np.eye(n)
     u = np.zeros([n,n])
-    for j in np.arange(1,n+1): # 1,n
-        l[j-1][j-1] = 1.
-        u[1-1][j-1] = a[1-1][j-1]
-        l[j-1][1-1] = a[j-1][1-1] / u[1-1][1-1]
-    for i in np.arange(2,n+1): # 2,n
-        sum = 0.
-        for k in np.arange(1,i): # 1,i-1
-            sum = sum + l[i-1][k-1]*u[k-1][i-1]
-        u[i-1][i-1] = a[i-1][i-1] - sum
-        for j in np.arange(i+1,n+1): # i+1,n
-            sum = 0.
-            for k in np.arange(1,i): # 1,i-1
-                sum = sum + l[i-1][k-1]*u[k-1][j-1]
-            u[i-1][j-1] = (a[i-1][j-1] -  sum) / l[i-1][i-1]
-            sum = 0.
-            for k in np.arange(1,i): # 1,i-1
-                sum = sum + l[j-1][k-1]*u[k-1][i-1]
-            l[j-1][i-1] = (a[j-1][i-1] - sum) / u[i-1][i-1]
+    for i in range(n):
+        u[i,i:]   = a[i,i:] - l[i,:i] @ u[:i,i:]
+        l[i+1:,i] = (a[i+1:,i] - l[i+1:,:i] @ u[:i,i]) / u[i,i]
     return l,u
 
 
-def lin_lu_solve(l,u,b):
+class LUFactor:
+    """
+    ----------------------------------------------
+    LU factorisation P A = L U of matrix A, as
+    returned by lin_lu_factor; L (unit diagonal) and
+    U are stored together in one array lu[n,n],
+    perm[n] is the row permutation (A[perm] = L U),
+    anorm the 1-norm of A. The factor can be reused
+    for many solves, the determinant, the inverse
+    and a condition estimate
+    ----------------------------------------------
+    """
+    def __init__(self,lu,perm,nswap,anorm=None):
+        self.lu    = lu
+        self.perm  = perm
+        self.nswap = nswap
+        self.anorm = anorm
+        self.n     = lu.shape[0]
+
+    @property
+    def l(self):
+        import numpy as np
+        return np.tril(self.lu,-1) + np.eye(self.n)
+
+    @property
+    def u(self):
+        import numpy as np
+        return np.triu(self.lu)
+
+    def solve(self,b):
+        '''
+        solve A x = b for b[n] or b[n,k] (b is not modified)
+        '''
+        import numpy as np
+        x = np.asarray(b,dtype=float)[self.perm]
+        x = lin_forward_substitution(self.lu,x,unit=True,overwrite_b=True)
+        return lin_backward_substitution(self.lu,x,overwrite_b=True)
+
+    def solve_transpose(self,b):
+        '''
+        solve A^T x = b for b[n] or b[n,k] (b is not modified)
+        '''
+        import numpy as np
+        lut = self.lu.T
+        y = lin_forward_substitution(lut,b)
+        y = lin_backward_substitution(lut,y,unit=True,overwrite_b=True)
+        x = np.empty_like(y)
+        x[self.perm] = y
+        return x
+
+    def det(self):
+        '''
+        determinant: product of pivots, sign from row interchanges
+        '''
+        import numpy as np
+        return (-1.)**self.nswap * np.prod(np.diagonal(self.lu))
+
+    def inverse(self):
+        '''
+        inverse matrix from n solves with the factor
+        '''
+        import numpy as np
+        return self.solve(np.eye(self.n))
+
+    def cond1(self,nmax=5):
+        '''
+        estimate of the 1-norm condition number |A|_1 |A^-1|_1,
+        |A^-1|_1 is estimated with a few solves (Hager's method),
+        the estimate is a lower bound, usually within a factor 3
+        '''
+        import numpy as np
+        x   = np.full(self.n,1./self.n)
+        est = 0.
+        for k in range(nmax):
+            y   = self.solve(x)
+            est = np.sum(np.abs(y))
+            xi  = np.where(y >= 0.,1.,-1.)
+            z   = self.solve_transpose(xi)
+            j   = np.argmax(np.abs(z))
+            if (k > 0 and np.abs(z[j]) <= z @ x):
+                break
+            x    = np.zeros(self.n)
+            x[j] = 1.
+        # extra test vector with alternating signs (Higham)
+        i = np.arange(self.n)
+        x = (-1.)**i * (1. + i/max(self.n-1,1))
+        est = max(est,2.*np.sum(np.abs(self.solve(x)))/(3.*self.n))
+        return self.anorm*est
+
+
+def _lin_lu_panel(lu,perm,k1,k2,pivot):
+    """
+    ----------------------------------------------
+    unblocked right-looking LU of columns k1:k2 of lu,
+    row interchanges are applied to whole rows,
+    the trailing update is restricted to columns <k2
+    output:
+    nswap   - number of row interchanges
+    ----------------------------------------------
+    """
+    import numpy as np
+    nswap = 0
+    for k in range(k1,k2):
+        if (pivot):
+            p = k + np.argmax(np.abs(lu[k:,k]))
+            if (p != k):
+                lu[[k,p]]   = lu[[p,k]]
+                perm[[k,p]] = perm[[p,k]]
+                nswap = nswap + 1
+        if (lu[k,k] == 0.):
+            raise np.linalg.LinAlgError('lin_lu_factor: matrix is singular')
+        lu[k+1:,k] /= lu[k,k]
+        lu[k+1:,k+1:k2] -= np.outer(lu[k+1:,k],lu[k,k+1:k2])
+    return nswap
+
+
+def lin_lu_factor(a,pivot=True,overwrite_a=False,nblock=64):
+    """
+    ----------------------------------------------
+    LU factorisation P A = L U with partial pivoting,
+    elimination updates whole rows and trailing
+    blocks with array operations; with nblock, panels
+    of nblock columns are factored first and the
+    trailing matrix is updated with one matrix product
+    per panel (blocked, cache efficient)
+    input:
+    a[n,n]      - coefficient matrix
+    pivot       - partial (row) pivoting (default True)
+    overwrite_a - reuse memory of a (float array) for
+                  the factors (default False)
+    nblock      - block size (default 64, None: unblocked)
+    output:
+    LUFactor    - factor object with lu, perm, solve()
+    needs:
+    _lin_lu_panel
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    """
+    import numpy as np
+    if (overwrite_a):
+        lu = np.asarray(a,dtype=float)
+    else:
+        lu = np.array(a,dtype=float)
+    n = lu.shape[0]
+    if (lu.ndim != 2 or lu.shape[1] != n):
+        raise ValueError('lin_lu_factor: matrix must be square')
+    anorm = np.max(np.sum(np.abs(lu),axis=0))
+    perm  = np.arange(n)
+    nswap = 0
+    if (nblock is None or nblock >= n):
+        nswap = _lin_lu_panel(lu,perm,0,n,pivot)
+    else:
+        for k in range(0,n,nblock):
+            k2 = min(k+nblock,n)
+            nswap = nswap + _lin_lu_panel(lu,perm,k,k2,pivot)
+            if (k2 < n):
+                # U12 = L11^-1 A12
+                for i in range(k+1,k2):
+                    lu[i,k2:] -= lu[i,k:i] @ lu[k:i,k2:]
+                # A22 = A22 - L21 U12
+                lu[k2:,k2:] -= lu[k2:,k:k2] @ lu[k:k2,k2:]
+    return LUFactor(lu,perm,nswap,anorm)
+
+
+def lin_forward_substitution(l,b,unit=False,overwrite_b=False,nblock=64):
     '''
     ----------------------------------------------
-    Solve system of linear equations a(n,n)*x(n) = b(n)
-    using the lower and upper triangular matrices L and U
+    Solve lower triangular system L x = b for one
+    or many right-hand sides b[n,k]. Blocks of nblock
+    rows are solved with row operations on all rhs,
+    the remaining rows are updated with one matrix
+    product per block
     input:
-    u[n,n]  - upper triangular matrix
-    l[n,n]  - lower triangular matrix
-    b[n]    - rhs vector
+    l[n,n]      - lower triangular matrix
+    b[n,(k)]    - rhs vector(s)
+    unit        - L has unit diagonal (not referenced)
+    overwrite_b - store solution in b (float array)
+                  instead of a copy (default False)
+    nblock      - block size (default 64)
     output:
-    x[n]    - solution vector
+    x[n,(k)]    - solution vector(s)
     needs:
     -
     from: Lecture Numerical methods in geoscience
     ----------------------------------------------
     '''
     import numpy as np
-    n = len(b)
+    if (overwrite_b):
+        x = np.asarray(b,dtype=float)
+    else:
+        x = np.array(b,dtype=float)
+    n = x.shape[0]
+    for k1 in range(0,n,nblock):
+        k2 = min(k1+nblock,n)
+        for i in range(k1,k2):
+            x[i] -= l[i,k1:i] @ x[k1:i]
+            if (not unit):
+                x[i] /= l[i,i]
+        if (k2 < n):
+            x[k2:] -= l[k2:,k1:k2] @ x[k1:k2]
+    return x
+
+
+def lin_backward_substitution(u,b,unit=False,overwrite_b=False,nblock=64):
+    '''
+    ----------------------------------------------
+    Solve upper triangular system U x = b for one
+    or many right-hand sides b[n,k], blocked as in
+    lin_forward_substitution
+    input:
+    u[n,n]      - upper triangular matrix
+    b[n,(k)]    - rhs vector(s)
+    unit        - U has unit diagonal (not referenced)
+    overwrite_b - store solution in b (float array)
+                  instead of a copy (default False)
+    nblock      - block size (default 64)
+    output:
+    x[n,(k)]    - solution vector(s)
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (overwrite_b):
+        x = np.asarray(b,dtype=float)
+    else:
+        x = np.array(b,dtype=float)
+    n = x.shape[0]
+    for k2 in range(n,0,-nblock):
+        k1 = max(k2-nblock,0)
+        for i in range(k2-1,k1-1,-1):
+            x[i] -= u[i,i+1:k2] @ x[i+1:k2]
+            if (not unit):
+                x[i] /= u[i,i]
+        if (k1 > 0):
+            x[:k1] -= u[:k1,k1:k2] @ x[k1:k2]
+    return x
+
+
+def lin_lu_solve(l,u,b,overwrite_b=False):
+    '''
+    ----------------------------------------------
+    Solve system of linear equations a(n,n)*x(n) = b(n)
+    using the lower and upper triangular matrices L and U
+    b can hold many right-hand sides b[n,k], b is not
+    modified, unless overwrite_b is set
+    input:
+    u[n,n]   - upper triangular matrix
+    l[n,n]   - lower triangular matrix
+    b[n,(k)] - rhs vector(s)
+    overwrite_b - reuse memory of b (default False)
+    output:
+    x[n,(k)] - solution vector(s)
+    needs:
+    lin_forward_substitution
+    lin_backward_substitution
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
     # solve decomposed system Ly=b with forward substitution
-    for i in np.arange(1,n+1): # 1,n
-        sum = 0.
-        for j in np.arange(1,i): # 1,i-1
-            sum = sum + l[i-1][j-1] * b[j-1]
-        b[i-1] = (b[i-1] - sum) / l[i-1][i-1]
+    y = lin_forward_substitution(l,b,overwrite_b=overwrite_b)
     # solve decomposed system Ux=y with backward substitution
-    x = np.zeros([n])
-    for i in np.arange(n-1,-1,step=-1): # n,1,-1
-        sum = 0.0
-        for j in np.arange(i+1,n): # i+1,n
-            sum = sum + u[i][j] * x[j]
-        x[i] = (b[i] - sum) / u[i][i]
+    x = lin_backward_substitution(u,y,overwrite_b=True)
+    return x
+
+
+def lin_tridiag(a,b,c,rhs,method='thomas'):
+    '''
+    ----------------------------------------------
+    Solve the system of linear equations A x = rhs
+    for a tri-diagonal matrix A, stored as vectors
+    a[n] - diagonal, b[n-1] - upper and c[n-1] - lower
+    diagonal (A[i,i+1] = b[i], A[i+1,i] = c[i]).
+    Many systems with the same structure are solved
+    at once: all arrays may have trailing dimensions
+    (a[n,k], ..., rhs[n,k]), which are broadcast.
+    No pivoting (diagonally dominant matrices)
+    input:
+    a[n,...]   - diagonal
+    b[n-1,...] - upper diagonal
+    c[n-1,...] - lower diagonal
+    rhs[n,...] - rhs vector(s)
+    method     - 'thomas': Thomas algorithm, O(n) loop
+                 'cr': cyclic reduction, O(n) work in
+                 log2(n) vectorized steps (large n)
+    output:
+    x[n,...]   - solution vector(s)
+    needs:
+    _lin_tridiag_cr
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    a   = np.asarray(a,dtype=float)
+    b   = np.asarray(b,dtype=float)
+    c   = np.asarray(c,dtype=float)
+    rhs = np.asarray(rhs,dtype=float)
+    n   = a.shape[0]
+    batch = np.broadcast_shapes(a.shape[1:],b.shape[1:],c.shape[1:],rhs.shape[1:])
+    # align trailing batch dimensions behind the leading axis
+    a,b,c,rhs = [x.reshape(x.shape[:1]+(1,)*(len(batch)-(x.ndim-1))+x.shape[1:])
+                 for x in (a,b,c,rhs)]
+    if (method == 'cr'):
+        lo = np.zeros((n,)+batch)
+        up = np.zeros((n,)+batch)
+        lo[1:]  = c
+        up[:-1] = b
+        di = np.broadcast_to(a,(n,)+batch)
+        d  = np.broadcast_to(rhs,(n,)+batch)
+        return _lin_tridiag_cr(lo,di,up,d)
+    elif (method != 'thomas'):
+        raise ValueError('lin_tridiag: unknown method '+str(method))
+    # forward sweep: LU decomposition and forward substitution
+    cp = np.zeros((n,)+batch)
+    x  = np.zeros((n,)+batch)
+    den   = a[0]
+    if (n > 1):
+        cp[0] = b[0]/den
+    x[0]  = rhs[0]/den
+    for i in range(1,n):
+        den = a[i] - c[i-1]*cp[i-1]
+        if (i < n-1):
+            cp[i] = b[i]/den
+        x[i] = (rhs[i] - c[i-1]*x[i-1])/den
+    # backward substitution
+    for i in range(n-2,-1,-1):
+        x[i] = x[i] - cp[i]*x[i+1]
+    return x
+
+
+def _lin_tridiag_cr(lo,di,up,d):
+    '''
+    ----------------------------------------------
+    cyclic reduction for tri-diagonal systems with
+    lower lo[n], diagonal di[n], upper up[n] diagonals
+    (lo[0] = up[n-1] = 0): odd equations are eliminated,
+    the even ones form a tri-diagonal system of half
+    the size, solved recursively
+    ----------------------------------------------
+    '''
+    import numpy as np
+    n = di.shape[0]
+    if (n == 1):
+        return d/di
+    ne = (n+1)//2
+    no = n//2
+    lo_o,di_o,up_o,d_o = lo[1::2],di[1::2],up[1::2],d[1::2]
+    # eliminate odd neighbours from even equations
+    alpha = -lo[2::2]/di_o[:ne-1]
+    gamma = -up[0::2][:no]/di_o
+    nlo = np.zeros(lo[0::2].shape)
+    nup = np.zeros(up[0::2].shape)
+    ndi = np.array(di[0::2])
+    nd  = np.array(d[0::2])
+    nlo[1:]  = alpha*lo_o[:ne-1]
+    nup[:no] = gamma*up_o
+    ndi[1:]  += alpha*up_o[:ne-1]
+    ndi[:no] += gamma*lo_o
+    nd[1:]   += alpha*d_o[:ne-1]
+    nd[:no]  += gamma*d_o
+    xe = _lin_tridiag_cr(nlo,ndi,nup,nd)
+    # back substitution for odd unknowns
+    xo = d_o - lo_o*xe[:no]
+    r  = min(no,ne-1)
+    xo[:r] -= up_o[:r]*xe[1:r+1]
+    x = np.zeros(d.shape)
+    x[0::2] = xe
+    x[1::2] = xo/di_o
+    return x
+
+
+def lin_tridiag_periodic(a,b,c,rhs):
+    '''
+    ----------------------------------------------
+    Solve the system of linear equations A x = rhs
+    for a cyclic (periodic) tri-diagonal matrix A,
+    a[n] - diagonal, b[n] - upper diagonal,
+    c[n] - lower diagonal, A[i,(i+1)%n] = b[i],
+    A[(i+1)%n,i] = c[i], so b[n-1] = A[n-1,0] and
+    c[n-1] = A[0,n-1] are the corner elements.
+    Sherman-Morrison formula with two calls of
+    lin_tridiag, trailing dimensions are batches
+    input:
+    a[n,...]   - diagonal
+    b[n,...]   - upper diagonal (with corner)
+    c[n,...]   - lower diagonal (with corner)
+    rhs[n,...] - rhs vector(s)
+    output:
+    x[n,...]   - solution vector(s)
+    needs:
+    lin_tridiag
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    a   = np.asarray(a,dtype=float)
+    b   = np.asarray(b,dtype=float)
+    c   = np.asarray(c,dtype=float)
+    rhs = np.asarray(rhs,dtype=float)
+    n   = a.shape[0]
+    if (n < 3):
+        raise ValueError('lin_tridiag_periodic: n must be at least 3')
+    alpha = b[n-1]
+    beta  = c[n-1]
+    gamma = -a[0]
+    aa = np.array(a)
+    aa[0]   = a[0] - gamma
+    aa[n-1] = a[n-1] - alpha*beta/gamma
+    x  = lin_tridiag(aa,b[:n-1],c[:n-1],rhs)
+    u  = np.zeros(x.shape)
+    u[0]   = gamma
+    u[n-1] = alpha
+    z  = lin_tridiag(aa,b[:n-1],c[:n-1],u)
+    fact = (x[0] + beta*x[n-1]/gamma) / (1. + z[0] + beta*z[n-1]/gamma)
+    return x - fact*z
+
+
+def lin_band_from_dense(a,kl,ku):
+    '''
+    ----------------------------------------------
+    store band matrix a[n,n] with kl lower and ku
+    upper diagonals in compact form
+    ab[ku+i-j,j] = a[i,j]  (LAPACK band storage)
+    input:
+    a[n,n]  - band matrix
+    kl,ku   - number of lower/upper diagonals
+    output:
+    ab[kl+ku+1,n] - compact band storage
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    a  = np.asarray(a,dtype=float)
+    n  = a.shape[0]
+    ab = np.zeros([kl+ku+1,n])
+    for k in range(-kl,ku+1):
+        d = np.diagonal(a,k)
+        if (k >= 0):
+            ab[ku-k,k:] = d
+        else:
+            ab[ku-k,:n+k] = d
+    return ab
+
+
+def lin_band_factor(ab,kl,ku,overwrite_ab=False):
+    '''
+    ----------------------------------------------
+    LU decomposition of a band matrix in compact
+    storage ab[ku+i-j,j] = A[i,j] without pivoting,
+    L and U stay within the band, memory O(n*(kl+ku)).
+    Trailing dimensions ab[kl+ku+1,n,...] are a batch
+    of matrices with the same band structure
+    input:
+    ab[kl+ku+1,n,...] - band matrix (compact storage)
+    kl,ku        - number of lower/upper diagonals
+    overwrite_ab - reuse memory of ab (default False)
+    output:
+    lub[kl+ku+1,n,...] - U and multipliers of L
+    raises:
+    numpy.linalg.LinAlgError, if a pivot is zero
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (overwrite_ab):
+        lub = np.asarray(ab,dtype=float)
+    else:
+        lub = np.array(ab,dtype=float)
+    n = lub.shape[1]
+    # pivots are final once used, a zero pivot is detected after the loop
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for k in range(n-1):
+            m = min(kl,n-1-k)
+            l = lub[ku+1:ku+1+m,k]
+            l /= lub[ku,k]
+            for dj in range(1,min(ku,n-1-k)+1):
+                lub[ku+1-dj:ku+1-dj+m,k+dj] -= l*lub[ku-dj,k+dj]
+    if (np.any(lub[ku] == 0.)):
+        raise np.linalg.LinAlgError('lin_band_factor: pivot element is zero')
+    return lub
+
+
+def lin_band_solve(lub,kl,ku,rhs,overwrite_b=False):
+    '''
+    ----------------------------------------------
+    Solve A x = rhs with the band LU decomposition
+    of lin_band_factor (forward and backward
+    substitution within the band)
+    input:
+    lub[kl+ku+1,n,...] - result of lin_band_factor
+    kl,ku       - number of lower/upper diagonals
+    rhs[n,...]  - rhs vector(s), a rhs without the batch
+                  dimensions of lub is shared by all systems
+    overwrite_b - reuse memory of rhs (default False,
+                  not possible for a shared rhs)
+    output:
+    x[n,...]    - solution vector(s)
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (overwrite_b):
+        x = np.asarray(rhs,dtype=float)
+    else:
+        x = np.array(rhs,dtype=float)
+    n = lub.shape[1]
+    # align batch dimensions of lub with (several) rhs
+    extra = x.ndim - (lub.ndim-1)
+    if (extra > 0):
+        lub = lub.reshape(lub.shape + (1,)*extra)
+    elif (extra < 0):
+        # shared rhs for a batch of factors (new array)
+        x = x.reshape(x.shape[:1] + (1,)*(-extra) + x.shape[1:])
+        x = np.array(np.broadcast_to(x,(n,)+lub.shape[2:]))
+    # solve Ly=b with forward substitution
+    for k in range(n-1):
+        m = min(kl,n-1-k)
+        x[k+1:k+1+m] -= lub[ku+1:ku+1+m,k]*x[k]
+    # solve Ux=y with backward substitution, column by column
+    for k in range(n-1,-1,-1):
+        x[k] /= lub[ku,k]
+        q = min(ku,k)
+        x[k-q:k] -= lub[ku-q:ku,k]*x[k]
     return x
 
 
+def lin_csr_from_dense(a):
+    '''
+    ----------------------------------------------
+    store matrix a[n,m] in compressed sparse row
+    (CSR) format: nonzero values, their column
+    indices and the row pointers, entries of row i
+    are values[irow[i]:irow[i+1]]
+    input:
+    a[n,m]        - matrix
+    output:
+    values[nnz]   - nonzero values
+    icol[nnz]     - column indices
+    irow[n+1]     - row pointers
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    a = np.asarray(a,dtype=float)
+    i,j = np.nonzero(a)
+    irow = np.zeros(a.shape[0]+1,dtype=int)
+    irow[1:] = np.cumsum(np.bincount(i,minlength=a.shape[0]))
+    return a[i,j],j,irow
+
 
+def lin_csr_matvec(values,icol,irow,x):
+    '''
+    ----------------------------------------------
+    matrix-vector product y = A x for a CSR matrix
+    input:
+    values,icol,irow - CSR matrix (see lin_csr_from_dense)
+    x[m]             - vector
+    output:
+    y[n]             - product
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    n    = len(irow)-1
+    rows = np.repeat(np.arange(n),np.diff(irow))
+    return np.bincount(rows,weights=values*x[icol],minlength=n)
+
+
+def _lin_csr_diagonal(values,icol,rows,n):
+    '''
+    diagonal of CSR matrix (rows: row index of each entry)
+    '''
+    import numpy as np
+    d = np.zeros(n)
+    on = (rows == icol)
+    d[rows[on]] = values[on]
+    if (np.any(d == 0.)):
+        raise np.linalg.LinAlgError('diagonal element is zero')
+    return d
+
+
+def _lin_csr_colors(icol,rows,n):
+    '''
+    ----------------------------------------------
+    split rows of a CSR matrix into independent sets
+    (colours): rows of one colour are not coupled by
+    any matrix entry, so they can be updated together
+    in a Gauss-Seidel sweep. Greedy colouring in row
+    order: each row gets the smallest colour not used
+    by its neighbours (red-black for 5-point grids)
+    ----------------------------------------------
+    '''
+    import numpy as np
+    off = (rows != icol)
+    ei  = np.concatenate([rows[off],icol[off]])
+    ej  = np.concatenate([icol[off],rows[off]])
+    # symmetric adjacency lists
+    order = np.argsort(ei,kind='stable')
+    ptr   = np.concatenate([[0],np.cumsum(np.bincount(ei,minlength=n))]).tolist()
+    adj   = ej[order].tolist()
+    color = [-1]*n
+    for i in range(n):
+        used = {color[j] for j in adj[ptr[i]:ptr[i+1]]}
+        c = 0
+        while (c in used):
+            c = c + 1
+        color[i] = c
+    color = np.array(color)
+    return [np.flatnonzero(color == k) for k in range(color.max()+1)]
+
+
+def lin_jacobi(values,icol,irow,b,x0=None,tol=1.e-8,nmax=1000,callback=None):
+    '''
+    ----------------------------------------------
+    Solve the system of linear equations A x = b for
+    a CSR matrix A with the Jacobi iteration
+    x_new = x + (b - A x) / D, one sweep is one
+    vectorized matrix-vector product
+    input:
+    values,icol,irow - CSR matrix (see lin_csr_from_dense)
+    b[n]      - rhs vector
+    x0[n]     - initial guess (warm start, default 0)
+    tol       - relative residual |b-Ax|/|b| (default 1e-8)
+    nmax      - max. number of iterations (default 1000)
+    callback  - callback(it,x,res), called every iteration
+                with the relative residual res
+    output:
+    x[n]      - solution vector
+    it        - number of iterations
+    res       - relative residual
+    needs:
+    _lin_csr_diagonal
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    b    = np.asarray(b,dtype=float)
+    n    = len(b)
+    rows = np.repeat(np.arange(n),np.diff(irow))
+    d    = _lin_csr_diagonal(values,icol,rows,n)
+    x    = np.zeros(n) if (x0 is None) else np.array(x0,dtype=float)
+    bnorm = np.linalg.norm(b)
+    bnorm = bnorm if (bnorm > 0.) else 1.
+    r   = b - np.bincount(rows,weights=values*x[icol],minlength=n)
+    res = np.linalg.norm(r) / bnorm
+    it  = 0
+    while (res > tol and it < nmax):
+        it  = it + 1
+        x   = x + r/d
+        r   = b - np.bincount(rows,weights=values*x[icol],minlength=n)
+        res = np.linalg.norm(r) / bnorm
+        if (callback is not None):
+            callback(it,x,res)
+    return x,it,res
+
+
+def lin_sor(values,icol,irow,b,omega=1.5,x0=None,tol=1.e-8,nmax=1000,callback=None):
+    '''
+    ----------------------------------------------
+    Solve the system of linear equations A x = b for
+    a CSR matrix A with successive over-relaxation
+    (SOR, omega=1: Gauss-Seidel). Rows are grouped into
+    colours of mutually uncoupled rows, each sweep
+    updates one colour after the other with array
+    operations (multicolour ordering, greedy colouring
+    gives red-black for 5-point finite-difference grids)
+    input:
+    values,icol,irow - CSR matrix (see lin_csr_from_dense)
+    b[n]      - rhs vector
+    omega     - relaxation parameter, 0 < omega < 2 (default 1.5)
+    x0[n]     - initial guess (warm start, default 0)
+    tol       - relative residual |b-Ax|/|b| (default 1e-8)
+    nmax      - max. number of iterations (default 1000)
+    callback  - callback(it,x,res), called every iteration
+    output:
+    x[n]      - solution vector
+    it        - number of iterations
+    res       - relative residual
+    needs:
+    _lin_csr_diagonal
+    _lin_csr_colors
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    b    = np.asarray(b,dtype=float)
+    n    = len(b)
+    rows = np.repeat(np.arange(n),np.diff(irow))
+    d    = _lin_csr_diagonal(values,icol,rows,n)
+    x    = np.zeros(n) if (x0 is None) else np.array(x0,dtype=float)
+    # entries of the rows of each colour
+    sweeps = []
+    for rc in _lin_csr_colors(icol,rows,n):
+        local = np.full(n,-1)
+        local[rc] = np.arange(len(rc))
+        e = np.flatnonzero(local[rows] >= 0)
+        sweeps.append((rc,local[rows[e]],values[e],icol[e]))
+    bnorm = np.linalg.norm(b)
+    bnorm = bnorm if (bnorm > 0.) else 1.
+    res   = np.linalg.norm(b - np.bincount(rows,weights=values*x[icol],minlength=n)) / bnorm
+    it    = 0
+    while (res > tol and it < nmax):
+        it = it + 1
+        for rc,lrow,val,col in sweeps:
+            r = b[rc] - np.bincount(lrow,weights=val*x[col],minlength=len(rc))
+            x[rc] = x[rc] + omega*r/d[rc]
+        res = np.linalg.norm(b - np.bincount(rows,weights=values*x[icol],minlength=n)) / bnorm
+        if (callback is not None):
+            callback(it,x,res)
+    return x,it,res
+
+
+def lin_gauss_seidel(values,icol,irow,b,x0=None,tol=1.e-8,nmax=1000,callback=None):
+    '''
+    ----------------------------------------------
+    Solve the system of linear equations A x = b for
+    a CSR matrix A with the Gauss-Seidel iteration
+    (lin_sor with omega=1)
+    input/output: see lin_sor
+    needs:
+    lin_sor
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    return lin_sor(values,icol,irow,b,omega=1.,x0=x0,tol=tol,nmax=nmax,callback=callback)
+
+
+def lin_cg(values,icol,irow,b,x0=None,tol=1.e-8,nmax=None,precondition=True,callback=None):
+    '''
+    ----------------------------------------------
+    Solve the system of linear equations A x = b for
+    a symmetric positive definite CSR matrix A with
+    the method of conjugate gradients, optionally
+    with diagonal (Jacobi) preconditioning
+    input:
+    values,icol,irow - CSR matrix (see lin_csr_from_dense)
+    b[n]      - rhs vector
+    x0[n]     - initial guess (warm start, default 0)
+    tol       - relative residual |b-Ax|/|b| (default 1e-8)
+    nmax      - max. number of iterations (default n)
+    precondition - diagonal preconditioning (default True)
+    callback  - callback(it,x,res), called every iteration
+    output:
+    x[n]      - solution vector
+    it        - number of iterations
+    res       - relative residual
+    needs:
+    _lin_csr_diagonal
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    b    = np.asarray(b,dtype=float)
+    n    = len(b)
+    nmax = n if (nmax is None) else nmax
+    rows = np.repeat(np.arange(n),np.diff(irow))
+    dinv = 1./_lin_csr_diagonal(values,icol,rows,n) if (precondition) else np.ones(n)
+    x    = np.zeros(n) if (x0 is None) else np.array(x0,dtype=float)
+    bnorm = np.linalg.norm(b)
+    bnorm = bnorm if (bnorm > 0.) else 1.
+    r   = b - np.bincount(rows,weights=values*x[icol],minlength=n)
+    res = np.linalg.norm(r) / bnorm
+    z   = dinv*r
+    p   = z.copy()
+    rz  = r @ z
+    it  = 0
+    while (res > tol and it < nmax):
+        it = it + 1
+        ap    = np.bincount(rows,weights=values*p[icol],minlength=n)
+        alpha = rz / (p @ ap)
+        x     = x + alpha*p
+        r     = r - alpha*ap
+        res   = np.linalg.norm(r) / bnorm
+        if (callback is not None):
+            callback(it,x,res)
+        z     = dinv*r
+        rznew = r @ z
+        p     = z + (rznew/rz)*p
+        rz    = rznew
+    return x,it,res
+
+
+def lin_factor_cached(a,key='content'):
+    '''
+    ----------------------------------------------
+    LU factor of matrix a from a small LRU cache,
+    the factorisation (lin_lu_factor) is only done,
+    if the matrix is not found in the cache
+    input:
+    a[n,n]  - coefficient matrix
+    key     - 'content': matrix is identified by a hash
+              of its values (safe, costs O(n^2))
+              'id': matrix is identified by the object,
+              changes to a in place are not detected
+    output:
+    LUFactor - factor object
+    needs:
+    lin_lu_factor
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (key == 'id'):
+        k = ('id',id(a))
+    elif (key == 'content'):
+        arr = np.ascontiguousarray(a,dtype=float)
+        k = ('content',arr.shape,hashlib.sha1(arr.tobytes()).hexdigest())
+    else:
+        raise ValueError('lin_factor_cached: unknown key '+str(key))
+    entry = _lu_cache.get(k)
+    # for id keys, the cached object must still be the same
+    if (entry is not None and (key == 'content' or entry[0] is a)):
+        _lu_cache.move_to_end(k)
+        return entry[1]
+    factor = lin_lu_factor(a)
+    _lu_cache[k] = (a if (key == 'id') else None,factor)
+    while (len(_lu_cache) > _lu_cache_maxsize):
+        _lu_cache.popitem(last=False)
+    return factor
+
+
+def lin_cache_clear():
+    '''
+    remove all LU factors from the cache of lin_factor_cached
+    '''
+    _lu_cache.clear()
+
+
+def lin_solve(a,b,key='content'):
+    '''
+    ----------------------------------------------
+    Solve A x = b, b[n] or b[n,k], with the cached
+    LU factor of A (see lin_factor_cached)
+    ----------------------------------------------
+    '''
+    return lin_factor_cached(a,key).solve(b)
+
+
+def lin_det(a,key='content'):
+    '''
+    ----------------------------------------------
+    determinant of A from the cached LU factor
+    (product of pivots, see lin_factor_cached)
+    ----------------------------------------------
+    '''
+    return lin_factor_cached(a,key).det()
+
+
+def lin_inverse(a,key='content'):
+    '''
+    ----------------------------------------------
+    inverse of A from the cached LU factor
+    (see lin_factor_cached)
+    ----------------------------------------------
+    '''
+    return lin_factor_cached(a,key).inverse()
+
+
+def lin_cond(a,key='content'):
+    '''
+    ----------------------------------------------
+    estimate of the 1-norm condition number of A
+    from the cached LU factor, O(n^2) per call
+    (see lin_factor_cached, LUFactor.cond1)
+    ----------------------------------------------
+    '''
+    return lin_factor_cached(a,key).cond1()
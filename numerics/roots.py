@@ -4,10 +4,49 @@ Lecture: Numerical methods in Geosciences
 Chapter 03: Roots
 (c) Georg Kaufmann
 ===============================================
+eval_array(f,x) evaluates a function on an array
+with one call, falling back to point-by-point calls
+for scalar functions; it is shared with the
+integrate and fitting modules.
 """
 
+from collections import namedtuple
 
-def root_bracket (f,a,b,n):
+# result of root_brent()
+RootResult = namedtuple('RootResult',['root','froot','niter','nfev','converged'])
+
+
+def eval_array(f,x):
+    '''
+    ----------------------------------------------
+    evaluate function f on the array x, calling f
+    once with the whole array; a scalar result is
+    broadcast (constant function), if f only accepts
+    scalars (or does not return an array of the
+    same shape), f is called point by point
+    input:
+    f       - function
+    x[n]    - evaluation points
+    output:
+    fx[n]   - function values as float array
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    try:
+        fx = np.asarray(f(x),dtype=float)
+        if (fx.shape == x.shape):
+            return fx
+        if (fx.ndim == 0):
+            return np.full(x.shape,float(fx))
+    except (TypeError,ValueError):
+        pass
+    return np.fromiter((f(xi) for xi in x),dtype=float,count=len(x))
+
+
+def root_bracket (f,a,b,n,vectorized=False,nchunk=100000):
     '''
     ----------------------------------------------
     Bracket possible roots of a function f in the
@@ -19,16 +58,22 @@ def root_bracket (f,a,b,n):
     a       - left boundary
     b       - right boundary
     n       - number of sub-intervals
+    vectorized=False - evaluate f on arrays of grid points
+              and detect sign changes with array operations
+    nchunk=100000    - max. number of sub-intervals evaluated
+              at once in vectorized mode (bounds memory)
     output:
     nb      - number of intervals with roots
     xb1[nb] - left interval boundaries
     xb1[nb] - right interval boundaries
     needs:
-    -   
+    eval_array (vectorized mode)
     from: Lecture Numerical methods in geoscience
     ----------------------------------------------
     '''
     import numpy as np
+    if (vectorized):
+        return _root_bracket_array(f,a,b,n,nchunk)
     nb  = 0
     xb1 = np.zeros([0])
     xb2 = np.zeros([0])
@@ -46,6 +91,59 @@ def root_bracket (f,a,b,n):
     return xb1,xb2,nb 
 
 
+def _root_bracket_array (f,a,b,n,nchunk):
+    '''
+    ----------------------------------------------
+    vectorized version of root_bracket: the grid
+    x_i = a + i*dx, i=0,n is processed in chunks of
+    at most nchunk sub-intervals, f is evaluated
+    once per chunk, and sign changes fa*fb <= 0 are
+    found with array operations. The last function
+    value of a chunk is carried over to the next one,
+    so every grid point is evaluated exactly once.
+    input:
+    f       - function (array or scalar)
+    a       - left boundary
+    b       - right boundary
+    n       - number of sub-intervals
+    nchunk  - max. number of sub-intervals per chunk
+    output:
+    xb1[nb] - left interval boundaries
+    xb2[nb] - right interval boundaries
+    nb      - number of intervals with roots
+    needs:
+    eval_array
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    n      = int(n)
+    nchunk = max(1,int(nchunk))
+    dx     = (b-a)/n
+    # collect indices i of sub-intervals [x_i,x_i+1] with a sign change
+    index  = []
+    fa     = eval_array(f,np.array([a],dtype=float))[0]
+    for i1 in range(0,n,nchunk):
+        i2 = min(i1+nchunk,n)
+        x  = a + dx*np.arange(i1+1,i2+1)
+        fx = eval_array(f,x)
+        fl = np.empty(len(fx))
+        fl[0]  = fa
+        fl[1:] = fx[:-1]
+        index.append(i1 + np.flatnonzero(fl*fx <= 0))
+        fa = fx[-1]
+    index = np.concatenate(index) if (len(index) > 0) else np.zeros(0,dtype=int)
+    # fill preallocated bracket arrays
+    nb  = len(index)
+    xb1 = np.empty(nb)
+    xb2 = np.empty(nb)
+    np.multiply(index,dx,out=xb1)
+    xb1 += a
+    np.multiply(index+1,dx,out=xb2)
+    xb2 += a
+    return xb1,xb2,nb
+
+
 def root_bisection (f,a,b,tol):
     '''
     ----------------------------------------------
@@ -158,3 +256,300 @@ def root_newton (f,df,a,tol):
         if (np.abs(fa) <= tol):
             return root_newton
     exit ('root_newton: too many iterations in root_newton')
+
+
+def root_bisection_array (f,a,b,tol,nmax=50):
+    '''
+    ----------------------------------------------
+    Find roots of a function f in many intervals
+    [a_i,b_i] at once with the bisection method.
+    All brackets are refined together, f is called
+    once per iteration with the array of midpoints
+    of the lanes that have not yet converged
+    Use root_bracket() before ...
+    input:
+    f       - function
+    a[nb]   - left boundaries of bracketed intervals
+    b[nb]   - right boundaries of bracketed intervals
+    tol     - accuracy for root
+    nmax=50 - max. number of iterations
+    output:
+    x0[nb]     - x coordinates of roots
+    niter[nb]  - number of iterations per lane
+    status[nb] - 0: converged, 1: too many iterations,
+                 2: root not bracketed
+    needs:
+    eval_array
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    a  = np.atleast_1d(np.asarray(a,dtype=float))
+    b  = np.atleast_1d(np.asarray(b,dtype=float))
+    nb = len(a)
+    niter  = np.zeros(nb,dtype=int)
+    status = np.ones(nb,dtype=int)
+    fa = eval_array(f,a)
+    fb = eval_array(f,b)
+    # flag lanes, where root is not bracketed
+    status[fa*fb > 0] = 2
+    # orient search such that f>0 lies at x+dx
+    x0 = np.where(fa <= 0.,a,b)
+    dx = np.where(fa <= 0.,b-a,a-b)
+    active = np.flatnonzero(status == 1)
+    for i in np.arange(1,nmax):
+        if (len(active) == 0):
+            break
+        dx[active] = dx[active]*0.5
+        xm  = x0[active] + dx[active]
+        fxm = eval_array(f,xm)
+        niter[active] = i
+        x0[active] = np.where(fxm <= 0.,xm,x0[active])
+        done = (np.abs(dx[active]) <= tol) | (fxm == 0.)
+        status[active[done]] = 0
+        active = active[~done]
+    return x0,niter,status
+
+
+def root_secant_array (f,a,b,tol,nmax=50):
+    '''
+    ----------------------------------------------
+    Find roots of a function f in many intervals
+    [a_i,b_i] at once with the secant method.
+    Function values of the last two iterates are
+    kept, so each iteration costs one call to f
+    with the array of lanes not yet converged
+    Use root_bracket() before ...
+    input:
+    f       - function
+    a[nb]   - left boundaries of bracketed intervals
+    b[nb]   - right boundaries of bracketed intervals
+    tol     - accuracy for root
+    nmax=50 - max. number of iterations
+    output:
+    x0[nb]     - x coordinates of roots
+    niter[nb]  - number of iterations per lane
+    status[nb] - 0: converged, 1: too many iterations,
+                 3: secant is horizontal (f(a)=f(b))
+    needs:
+    eval_array
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    a  = np.array(np.atleast_1d(a),dtype=float)
+    b  = np.array(np.atleast_1d(b),dtype=float)
+    nb = len(a)
+    niter  = np.zeros(nb,dtype=int)
+    status = np.ones(nb,dtype=int)
+    x0 = b.copy()
+    fa = eval_array(f,a)
+    fb = eval_array(f,b)
+    active = np.arange(nb)
+    for i in np.arange(1,nmax):
+        # stop lanes with horizontal secant
+        flat = (fb[active] == fa[active])
+        status[active[flat]] = 3
+        active = active[~flat]
+        if (len(active) == 0):
+            break
+        aa  = a[active]
+        bb  = b[active]
+        xm  = bb - fb[active] * (bb-aa) / (fb[active]-fa[active])
+        fxm = eval_array(f,xm)
+        niter[active] = i
+        x0[active] = xm
+        a[active]  = bb
+        fa[active] = fb[active]
+        b[active]  = xm
+        fb[active] = fxm
+        done = (np.abs(bb-aa) <= tol) | (fxm == 0.)
+        status[active[done]] = 0
+        active = active[~done]
+    return x0,niter,status
+
+
+def root_newton_array (f,df,a,tol,nmax=50):
+    '''
+    ----------------------------------------------
+    Find roots of a function f close to many points
+    a_i at once with the Newton-Raphson method.
+    f and df are called once per iteration with
+    the array of lanes not yet converged
+    input:
+    f,df    - function and its first derivative
+    a[nb]   - initial guesses of roots
+    tol     - desired tolerance for |f(root)|
+    nmax=50 - max. number of iterations
+    output:
+    x0[nb]     - roots
+    niter[nb]  - number of iterations per lane
+    status[nb] - 0: converged, 1: too many iterations,
+                 3: derivative is zero
+    needs:
+    eval_array
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    x0 = np.array(np.atleast_1d(a),dtype=float)
+    nb = len(x0)
+    niter  = np.zeros(nb,dtype=int)
+    status = np.ones(nb,dtype=int)
+    fx = eval_array(f,x0)
+    active = np.arange(nb)
+    for i in np.arange(1,nmax):
+        if (len(active) == 0):
+            break
+        dfx  = eval_array(df,x0[active])
+        flat = (dfx == 0.)
+        status[active[flat]] = 3
+        active = active[~flat]
+        dfx    = dfx[~flat]
+        if (len(active) == 0):
+            break
+        x0[active] = x0[active] - fx[active] / dfx
+        fx[active] = eval_array(f,x0[active])
+        niter[active] = i
+        done = (np.abs(fx[active]) <= tol)
+        status[active[done]] = 0
+        active = active[~done]
+    return x0,niter,status
+
+
+def _cached_function (f,cache):
+    '''
+    ----------------------------------------------
+    wrap function f such that every abscissa x is
+    evaluated only once; values are stored in the
+    dictionary cache, the wrapper counts the true
+    calls to f in its attribute nfev
+    input:
+    f       - function
+    cache   - dictionary {x: f(x)}
+    output:
+    fcached - memoizing function
+    needs:
+    -
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    def fcached(x):
+        x = float(x)
+        if (x not in cache):
+            cache[x] = float(f(x))
+            fcached.nfev = fcached.nfev + 1
+        return cache[x]
+    fcached.nfev = 0
+    return fcached
+
+
+def root_brent (f,a,b,tol,nmax=100,cache=None):
+    '''
+    ----------------------------------------------
+    Find root of a function f in the interval [a,b]
+    with Brent's method, combining bisection with
+    secant and inverse quadratic interpolation steps.
+    The bracket is kept at all times, and a bisection
+    step is forced whenever the bracket has not at
+    least halved over the last two steps (or in the
+    interpolation step following a bisection), so the
+    method needs at most about twice the iterations of
+    bisection, e.g. for multiple roots, but converges
+    superlinearly for smooth functions.
+    Evaluations of f are memoized in cache, pass
+    the same dictionary to several calls to share
+    function values between them.
+    The interval should contain a sign change
+    Use root_bracket() before ...
+    input:
+    f        - function
+    a        - left boundary of bracketed interval
+    b        - right boundary of bracketed interval
+    tol      - accuracy for root
+    nmax=100 - max. number of iterations
+    cache={} - dictionary of known function values
+    output:
+    RootResult with fields
+    root      - x coordinate of root
+    froot     - function value at root
+    niter     - number of iterations
+    nfev      - number of (uncached) calls to f
+    converged - True, if tolerance has been reached
+    needs:
+    _cached_function
+    from: Lecture Numerical methods in geoscience
+    ----------------------------------------------
+    '''
+    import numpy as np
+    if (cache is None):
+        cache = {}
+    fc_ = _cached_function(f,cache)
+    eps = np.finfo(float).eps
+    fa  = fc_(a)
+    fb  = fc_(b)
+    # raise error, when root is not bracketed
+    if (fa*fb > 0):
+        raise ValueError('root_brent: root not bracketed')
+    c  = b
+    fc = fb
+    d  = b-a
+    e  = d
+    # bracket widths before the last two steps, bisection flags of these steps
+    w1 = w2 = np.inf
+    bis1 = bis2 = False
+    for i in np.arange(1,nmax+1):
+        # keep root between b and c
+        if ((fb > 0. and fc > 0.) or (fb < 0. and fc < 0.)):
+            c  = a
+            fc = fa
+            d  = b-a
+            e  = d
+        # b is the best estimate so far
+        if (abs(fc) < abs(fb)):
+            a,b,c    = b,c,b
+            fa,fb,fc = fb,fc,fb
+        tol1 = 2.*eps*abs(b) + 0.5*tol
+        xm   = 0.5*(c-b)
+        if (abs(xm) <= tol1 or fb == 0.):
+            return RootResult(b,fb,int(i)-1,fc_.nfev,True)
+        # force bisection, if the bracket has not halved over the last
+        # two steps, or in the interpolation step after a bisection
+        slow   = (abs(c-b) > 0.5*(w1 if bis2 else w2))
+        w1,w2  = abs(c-b),w1
+        bis    = True
+        if (not slow and abs(e) >= tol1 and abs(fa) > abs(fb)):
+            # try secant (a=c) or inverse quadratic interpolation
+            s = fb/fa
+            if (a == c):
+                p = 2.*xm*s
+                q = 1.-s
+            else:
+                q = fa/fc
+                r = fb/fc
+                p = s*(2.*xm*q*(q-r) - (b-a)*(r-1.))
+                q = (q-1.)*(r-1.)*(s-1.)
+            if (p > 0.):
+                q = -q
+            p = abs(p)
+            # accept interpolation only if it stays well inside the bracket
+            if (2.*p < min(3.*xm*q-abs(tol1*q),abs(e*q))):
+                e = d
+                d = p/q
+                bis = False
+            else:
+                d = xm
+                e = d
+        else:
+            # bisection step
+            d = xm
+            e = d
+        bis1,bis2 = bis,bis1
+        a  = b
+        fa = fb
+        if (abs(d) > tol1):
+            b = b + d
+        else:
+            b = b + np.copysign(tol1,xm)
+        fb = fc_(b)
+    return RootResult(b,fb,int(nmax),fc_.nfev,False)
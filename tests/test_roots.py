@@ -0,0 +1,18 @@
+import math
+
+import numerics.roots
+
+
+def test_brent_simple_root():
+    res = numerics.roots.root_brent(math.cos,0.,3.,1.e-12)
+    assert res.converged
+    assert abs(res.root - math.pi/2.) < 1.e-12
+
+
+def test_brent_multiple_root():
+    # triple root: interpolation converges linearly, bisection must take over
+    nbisect = math.ceil(math.log2(3./1.e-12))
+    res = numerics.roots.root_brent(lambda x: (x-1.)**3,0.,3.,1.e-12)
+    assert res.converged
+    assert abs(res.root - 1.) < 1.e-12
+    assert res.niter <= 2*nbisect